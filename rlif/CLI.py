@@ -4,6 +4,7 @@ from rlif.learning import Trainer, get_parameters
 import rlif.environments
 from rlif.settings import ConfigManager as settings
 from rlif.rna import colorize_nucleotides, highlight_mismatches
+from rlif.rna import set_vienna_params
 import numpy as np
 import RNA
 
@@ -16,11 +17,6 @@ param_files = {
     4: 'rna_langdon2018.par',
 }
 
-def set_vienna_params(param):
-    params = os.path.join(settings.MAIN_DIR, 'utils', param_files[param])
-    RNA.read_parameter_file(params)
-
-
 def sort_by_free_energy(designs):
     FE = np.argsort([design.fe for design in designs])
     return [designs[i] for i in FE]
@@ -54,6 +50,7 @@ def solution_summary(designs, hd=False):
             content += ' HD: {:2}'.format(design.hd)
         print('Seq #{:4}: {}   FE: {:.3f}'.format(
             i+1, colorize_nucleotides(design.string), design.fe) + content)
+        design.release()
 
 
 def mismatch_summary(designs):
@@ -68,13 +65,11 @@ def mismatch_summary(designs):
         _, mismatches = highlight_mismatches(
             design.target.seq, design.folded_structure)
         gcau = design.gcau_content()
-        dist = RNA.dist_mountain(target, design.folded_structure)
-        d4 = RNA.bp_distance(target, design.folded_structure)
         content = '  ||  G:{:.2f} | C:{:.2f} | A:{:.2f} | U:{:.2f} |'.format(
             gcau['G'], gcau['C'], gcau['A'], gcau['U'])
         content += ' | HD: {:2}'.format(design.hd)
-        content += ' | MD: {:.3f}'.format(dist)
-        content += ' | BPD: {:2}'.format(d4)
+        content += ' | MD: {:.3f}'.format(design.md)
+        content += ' | BPD: {:2}'.format(design.bpd)
         print('{:4}: {}   FE: {:.3f}'.format(
             i+1, mismatches, design.fe) + content)
         print('    : {}'.format(colorize_nucleotides(design.string)))
@@ -99,6 +94,7 @@ def config_summary(args):
         '\nConfiguration: \n',
         'Number of solutions:      %i\n' % args.num_solutions,
         'Attempts per solution:    %i\n' % args.attempts,
+        'Attempts per batch:       %i\n' % args.batch_size,
         # 'Model:                    %s\n' % settings.model_args[int(args.model)],
         'Show structure:           %r\n' % args.show,
         'Display failed sequences: %r\n' % args.failed,
@@ -135,12 +131,13 @@ def fold(model, args):
             budget=args.attempts,
             permute=args.permute,
             show=args.show,
-            verbose=args.verbosity)
+            verbose=args.verbosity,
+            batch_size=args.batch_size)
 
     unique = find_unique(valid)
     t = time.time() - t0
     mult = 6 if args.multi else 1
-    attempts = model.model.env.get_attr('ep')[0]
+    attempts = model.model.env.get_attr('ep')[0] if args.multi else model.attempts
     print(header, 'Solutions found: {}, unique: {}, time taken: {:.2f}s, total attempts: {}, solutions/s: {:.2f}, attempts/s: {:.2f}\n'.format(
         len(valid),
         len(unique),
@@ -180,6 +177,7 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--failed', action='store_true')
     parser.add_argument('-p', '--permute', action='store_false')
     parser.add_argument('-c', '--vienna_config', type=int, default=1)
+    parser.add_argument('-b', '--batch_size', type=int, default=1)
     parser.add_argument('--multi', action='store_true')
     args = parser.parse_args()
     parser.print_help()
@@ -225,6 +223,8 @@ if __name__ == "__main__":
                     args.num_solutions = int(target[1:])
                 elif target.startswith('a'):
                     args.attempts = int(target[1:])
+                elif target.startswith('b'):
+                    args.batch_size = int(target[1:])
                 elif target.startswith('m'):
                     args.model = str(target[1:])
                     params = settings.model_dict[args.model]
@@ -1,10 +1,67 @@
 import numpy as np
 import gym, time, os, random, sys
+from collections import OrderedDict
 from rlif.settings import ConfigManager as settings
 from rlif.rna import Dataset, Solution, DotBracket
  
+def memory_usage():
+    """
+    Resident, proportional (shared pages divided between the processes mapping them)
+    and private memory of the current process in MB, zeros where /proc is not available
+    """
+    fields = dict(Rss=0, Pss=0, Private_Clean=0, Private_Dirty=0)
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                if name in fields:
+                    fields[name] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    private = fields['Private_Clean'] + fields['Private_Dirty']
+    return fields['Rss'] / 1024, fields['Pss'] / 1024, private / 1024
+
+
+# Number of datasets kept by the environments for configure
+DATASET_CACHE_SIZE = 4
+
+def remember_dataset(datasets, key, dataset=None):
+    """
+    LRU store of the datasets received by configure, by content hash
+    configure_env applies the same updates to its record of the sent datasets,
+    so that both sides evict the same keys
+    """
+    if dataset is not None:
+        datasets[key] = dataset
+    datasets.move_to_end(key)
+    while len(datasets) > DATASET_CACHE_SIZE:
+        datasets.popitem(last=False)
+    return datasets[key]
+
+def configure_env(env, **changes):
+    """
+    Apply a batch of changes to all of the environments of a vectorized env
+    with a single env_method call (see RnaDesign.configure)
+
+    A dataset is pickled to the workers only if they do not hold it already,
+    otherwise they look it up by its content hash
+    """
+    dataset = changes.pop('dataset', None)
+    if dataset is not None:
+        key = dataset.key()
+        if not hasattr(env, 'sent_datasets'):
+            env.sent_datasets = OrderedDict()
+        if key in env.sent_datasets:
+            changes['dataset_key'] = key
+            remember_dataset(env.sent_datasets, key)
+        else:
+            changes['dataset'] = (key, dataset)
+            remember_dataset(env.sent_datasets, key, True)
+    return env.env_method('configure', **changes)
+
+
 class RnaDesign(gym.Env):
-    def __init__(self, config=None, rank=None):
+    def __init__(self, config=None, rank=None, dataset=None):
         self.config = config
         self.env_id = rank
 
@@ -23,7 +80,8 @@ class RnaDesign(gym.Env):
 
         # Data
         self.current_sequence = -1
-        self.dataset = self.load_data()
+        self.dataset = self.load_data() if dataset is None else dataset
+        self.datasets = OrderedDict() # Datasets received by configure (see remember_dataset)
         self.next_target_structure()
         self.prev_solution = None
 
@@ -59,26 +117,29 @@ class RnaDesign(gym.Env):
     def step(self, action):
         """
         Generate a nucleotide at the current location
+        The info of the last step holds the EpisodeResult of the evaluated design
         """
         solution = self.solution
         solution.insert_nucleotide(action)
 
-        if solution.index < self.target_structure.len - 1:
+        info = {}
+        if not solution.filled:
             solution.find_next_unfilled()
         else:
+            # The statistics are left to the consumers of the result (computed on first access)
             self.done = True
             solution.evaluate(
                 reward=True,
                 permute=self.permute,
                 verbose=False,
-                compute_statistics=self.testing_mode,
                 boost=self.boosting)
+            info['result'] = solution.result()
 
             # print(solution.string)
             # print(solution.target, '\n', solution.r, solution.hd)
         state, reward = solution.get_state(reshape=self.use_mlp), solution.r
 
-        return state, reward, self.done, {}
+        return state, reward, self.done, info
 
     def next_target_structure(self):
         """
@@ -96,14 +157,45 @@ class RnaDesign(gym.Env):
         """
         Loads a dataset
         """
+        return self.load_dataset(self.config)
+
+    @staticmethod
+    def load_dataset(config):
+        """
+        Training dataset of the config, loaded once by the trainer and shared by the workers
+        """
         dataset = Dataset(
             dataset='rfam_train',
-            length=self.config['seq_len'],
-            n_seqs=self.config['seq_count'],
-            encoding_type=self.config['encoding_type'])
+            length=config['seq_len'],
+            n_seqs=config['seq_count'],
+            encoding_type=config['encoding_type'])
         
         return dataset
 
+    def memory_usage(self):
+        return memory_usage()
+
+    def configure(self, dataset=None, dataset_key=None, config=None, next_target=False, **changes):
+        """
+        Apply a batch of changes in a single call (one round trip per worker, see configure_env)
+
+        dataset:     (key, Dataset), kept under its key for the later calls
+        dataset_key: key of one of the last DATASET_CACHE_SIZE datasets received
+        config:      entries to update in the environment config
+        next_target: load the next target structure once the changes are applied
+        The remaining keyword arguments are set as attributes
+        """
+        if dataset is not None:
+            self.dataset = remember_dataset(self.datasets, *dataset)
+        elif dataset_key is not None:
+            self.dataset = remember_dataset(self.datasets, dataset_key)
+        if config is not None:
+            self.config = {**self.config, **config}
+        for name, value in changes.items():
+            setattr(self, name, value)
+        if next_target:
+            self.next_target_structure()
+
     def set_data(self, data):
         self.current_sequence = -1
         self.dataset = data
@@ -1 +1,2 @@
-from .RLIFenv import RnaDesign
+from .RLIFenv import RnaDesign, configure_env
+from .batched import BatchedRnaDesign
@@ -0,0 +1,385 @@
+import numpy as np
+import gym, time, random, functools
+from collections import deque, OrderedDict
+from stable_baselines.common.vec_env import VecEnv
+from rlif.settings import ConfigManager as settings
+from rlif.rna import Solution, DotBracket, fold_cache, fold_many
+from rlif.rna.vienna import get_fold_engine, cache_key
+from rlif.rna.rnafold import RNAfoldPool
+from .RLIFenv import RnaDesign, memory_usage, remember_dataset
+
+
+class BatchedRnaDesign(VecEnv):
+    """
+    RnaDesign vectorized in a single process
+
+    The encodings, sequences, pair tables and fill schedules of all n_envs episodes
+    are kept in stacked arrays and a step advances all of them with array indexing.
+    Solutions are only created at the end of an episode, when the designs are
+    evaluated (the folds go to the worker pool of fold_many).
+
+    Behaves like a DummyVecEnv of RnaDesign environments: episodes are reset
+    automatically and get_attr/set_attr/env_method accept the same names
+    ('target_structure', 'prev_solution', 'next_target_structure', ...)
+    and the info of the step that ends an episode holds its EpisodeResult
+
+    With async_evaluation the finished designs are folded in the background while
+    their slots already play the next episode. The step that ends an episode then
+    returns a reward of 0 and the actual reward is handed out later by collect_rewards,
+    tagged with the step and slot, so that the rollout can be corrected (AsyncRunner)
+    """
+    # Attributes of the single environments, stored per episode slot
+    slot_attributes = {
+        'target_structure': 'targets',
+        'prev_solution'   : 'prev_solutions',
+        'current_sequence': 'current_sequences',
+        'ep'              : 'episodes'}
+    # Methods of the single environments, called with the slot as the first argument
+    slot_methods = ['next_target_structure', 'reset_slot', 'get_solution']
+
+    def __init__(self, config=None, n_envs=1, dataset=None):
+        self.config = config
+
+        # Parameters
+        self.randomize     = True
+        self.meta_learning = True
+        self.permute       = self.config['permute']
+        self.verbose       = self.config['verbose']
+        self.boosting = False
+        self.use_mlp  = False
+        self.testing_mode = True
+        self.kernel_size = config['kernel_size']
+        self.use_nucleotides = bool(config.get('use_nucleotides'))
+        self.async_evaluation = bool(config.get('async_evaluation'))
+
+        # Data
+        self.dataset = RnaDesign.load_dataset(config) if dataset is None else dataset
+        self.datasets = OrderedDict() # Datasets received by configure (see remember_dataset)
+        self.targets = [None] * n_envs
+        self.prev_solutions = [None] * n_envs
+        self.current_sequences = [-1] * n_envs
+        self.episodes = [0] * n_envs
+
+        # Episode state
+        self.slots = np.arange(n_envs)
+        self.steps = np.zeros(n_envs, dtype=np.int64)      # Position in the fill schedule
+        self.indices = np.zeros(n_envs, dtype=np.int64)    # Current nucleotide
+        self.last_steps = np.zeros(n_envs, dtype=np.int64) # Episode lengths - 1
+        self.starts = np.zeros(n_envs)
+        self.step_count = 0
+        self.pending = deque() # Background folds: (step, slots, solutions, AsyncResult)
+        self.delayed_rewards = [] # (step, slot, reward) of the evaluated background folds
+        self.capacity = 0
+        template = self.dataset.sequences[0].padded_encoding(self.kernel_size, self.use_nucleotides)
+        self.rows = self.dataset.sequences[0].structure_encoding.shape[0]
+        self.encodings = np.zeros([n_envs, template.shape[0], 2 * self.kernel_size], dtype=np.uint8)
+        self.windows = None
+        self.sequences = np.zeros([n_envs, 0], dtype=np.uint8)
+        self.pair_tables = np.zeros([n_envs, 0], dtype=np.int64)
+        self.schedules = np.zeros([n_envs, 0], dtype=np.int64)
+
+        # Action -> ASCII codes of the nucleotide and its pair, index of the pair action
+        self.first_codes  = np.array([Solution.codes[a][0] for a in sorted(Solution.codes)], dtype=np.uint8)
+        self.second_codes = np.array([Solution.codes[a][1] for a in sorted(Solution.codes)], dtype=np.uint8)
+        self.reverse_action = np.array([Solution.reverse_action[a] for a in sorted(Solution.reverse_action)])
+
+        for slot in self.slots:
+            self.next_target_structure(slot)
+
+        state_size = self.observe().shape[1:]
+        observation_space = gym.spaces.Box(shape=state_size, low=0, high=1, dtype=np.uint8)
+        VecEnv.__init__(self, n_envs, observation_space, gym.spaces.Discrete(4))
+        self.actions = None
+
+    def reserve(self, length):
+        """
+        Grow the stacked arrays to fit targets of the given length
+        """
+        if length <= self.capacity:
+            return
+        n_envs, rows, width = self.encodings.shape
+        old = self.capacity
+        encodings = np.zeros([n_envs, rows, length + 2 * self.kernel_size], dtype=np.uint8)
+        encodings[:, :, :width] = self.encodings
+        self.encodings = encodings
+        for name, fill in [('sequences', ord('-')), ('pair_tables', -1), ('schedules', 0)]:
+            array = getattr(self, name)
+            grown = np.full([n_envs, length], fill, dtype=array.dtype)
+            grown[:, :old] = array
+            setattr(self, name, grown)
+        self.capacity = length
+
+        # Read-only view of every window of the encodings: [slot, row, nucleotide, 2 * kernel_size]
+        s0, s1, s2 = encodings.strides
+        self.windows = np.lib.stride_tricks.as_strided(
+            encodings,
+            shape=(n_envs, rows, length, 2 * self.kernel_size),
+            strides=(s0, s1, s2, s2),
+            writeable=False)
+
+    def start_episode(self, slot):
+        """
+        Empty design of the current target of the slot
+        """
+        target = self.targets[slot]
+        self.reserve(target.len)
+        template = target.padded_encoding(self.kernel_size, self.use_nucleotides)
+        self.encodings[slot] = 0
+        self.encodings[slot, :, :template.shape[1]] = template
+        self.sequences[slot] = ord('-')
+        self.pair_tables[slot] = -1
+        self.pair_tables[slot, :target.len] = target.pair_table
+        self.schedules[slot, :target.episode_length] = target.schedule
+        self.steps[slot] = 0
+        self.indices[slot] = target.schedule_list[0]
+        self.last_steps[slot] = target.episode_length - 1
+        self.starts[slot] = time.time()
+
+    def next_target_structure(self, slot):
+        """
+        Get the next target secondary structure of the slot from the dataset
+        """
+        if self.randomize:
+            index = random.randint(0, self.dataset.n_seqs-1)
+        else:
+            l = len(self.dataset.sequences) if len(self.dataset.sequences) > 0 else 1
+            index = self.current_sequences[slot] = (self.current_sequences[slot] + 1) % l
+        self.targets[slot] = self.dataset.sequences[index]
+        self.start_episode(slot)
+
+    def reset_slot(self, slot):
+        """
+        Start the next episode of the slot
+        """
+        self.episodes[slot] += 1
+        solution = self.prev_solutions[slot]
+        if self.verbose and solution is not None:
+            summary = '                                    '
+            summary += 'Ep: {:6}, Seq: {:5}, Len : {:3}, Reward: {:5f}, HD: {:3}'.format(
+                self.episodes[slot],
+                solution.target.file_nr,
+                solution.target.len,
+                solution.r,
+                solution.hd)
+            print(summary, end='\r')
+
+        if self.meta_learning:
+            self.next_target_structure(slot)
+        else:
+            self.start_episode(slot)
+
+    def reset(self):
+        for slot in self.slots:
+            self.reset_slot(slot)
+        return self.observe()
+
+    def observe(self):
+        """
+        Windows around the current nucleotide of every episode
+        """
+        states = self.windows[self.slots, :, self.indices] # [slot, row, 2 * kernel_size]
+        if self.use_mlp:
+            return states.reshape(len(self.slots), -1)
+        return states[:, :, :, np.newaxis]
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        """
+        Insert the nucleotides of the actions at the current positions, evaluate
+        the finished designs and reset their slots
+        """
+        actions = np.asarray(self.actions, dtype=np.int64).reshape(-1)
+        slots, i, k = self.slots, self.indices, self.kernel_size
+
+        # Unpaired nucleotides
+        self.encodings[slots, self.rows + actions, i + k] = 1
+        self.sequences[slots, i] = self.first_codes[actions]
+
+        # Base pairs (opening brackets)
+        pair_indices = self.pair_tables[slots, i]
+        paired = pair_indices > i
+        if paired.any():
+            paired_slots, pair_indices, paired_actions = slots[paired], pair_indices[paired], actions[paired]
+            self.encodings[paired_slots, self.rows + self.reverse_action[paired_actions], pair_indices + k] = 1
+            self.sequences[paired_slots, pair_indices] = self.second_codes[paired_actions]
+
+        # Advance to the next unfilled nucleotide
+        dones = self.steps >= self.last_steps
+        self.steps += ~dones
+        self.indices = self.schedules[slots, self.steps]
+
+        rewards = np.zeros(len(slots), dtype=np.float32)
+        infos = [{} for _ in slots]
+        finished = np.flatnonzero(dones)
+        if len(finished) > 0:
+            solutions = self.finish(finished)
+            if self.asynchronous:
+                self.submit(finished, solutions)
+            else:
+                for slot, solution in zip(finished, self.evaluate(solutions)):
+                    rewards[slot] = solution.r
+                    infos[slot]['result'] = solution.result()
+                    self.prev_solutions[slot] = solution
+            for slot in finished:
+                self.reset_slot(slot)
+        if self.pending:
+            self.resolve()
+        self.step_count += 1
+
+        return self.observe(), rewards, dones, infos
+
+    def get_solution(self, slot):
+        """
+        Solution holding the current design of the slot
+        """
+        target = self.targets[slot]
+        solution = Solution(target=target, config=self.config)
+        solution.sequence = bytearray(self.sequences[slot, :target.len].tobytes())
+        solution.recount()
+        solution.encoding[:] = self.encodings[slot, :, :solution.encoding.shape[1]]
+        solution.step, solution.index = int(self.steps[slot]), int(self.indices[slot])
+        solution.start = float(self.starts[slot]) # Plain float in the EpisodeResult
+        return solution
+
+    def finish(self, slots):
+        """
+        Solutions of the finished designs of the slots, boosted if enabled
+        """
+        solutions = [self.get_solution(slot) for slot in slots]
+        if self.boosting:
+            for solution in solutions:
+                solution.boost()
+        return solutions
+
+    def evaluate(self, solutions, folded=None):
+        """
+        Reward the solutions, folding them in parallel unless the folds are given
+        The statistics are computed on first access
+        """
+        if folded is None:
+            folded = [None] * len(solutions)
+            if len(solutions) > 1 and settings.WORKERS > 1:
+                folded = fold_many([solution.string for solution in solutions], parameters=solutions[0].parameters)
+
+        for solution, result in zip(solutions, folded):
+            solution.evaluate(
+                reward=True,
+                permute=self.permute,
+                verbose=False,
+                folded=result)
+        return solutions
+
+    @property
+    def asynchronous(self):
+        """
+        Whether the finished designs are evaluated in the background: only while
+        training (testing_mode off) and with the process pool of the fold engine
+        """
+        return (self.async_evaluation and not self.testing_mode and settings.WORKERS > 1
+                and not isinstance(settings.fold_fn, RNAfoldPool))
+
+    def submit(self, slots, solutions):
+        """
+        Fold the solutions of the slots in the background
+        """
+        strings = [solution.string for solution in solutions]
+        result = get_fold_engine().submit(enumerate(strings), solutions[0].parameters)
+        self.pending.append((self.step_count, slots, solutions, result))
+
+    def resolve(self, wait=False):
+        """
+        Evaluate the solutions of the completed background folds (of all of them if wait)
+        """
+        remaining = deque()
+        while self.pending:
+            entry = self.pending.popleft()
+            step, slots, solutions, result = entry
+            if not wait and not result.ready():
+                remaining.append(entry)
+                continue
+            folded = [fold for _, fold in result.get()]
+            for solution, fold in zip(solutions, folded):
+                fold_cache.put(solution.string, fold, key=cache_key(solution.string, solution.parameters), miss=True)
+            for slot, solution in zip(slots, self.evaluate(solutions, folded)):
+                self.prev_solutions[slot] = solution
+                self.delayed_rewards.append((step, slot, solution.r))
+        self.pending = remaining
+
+    def collect_rewards(self, wait=True):
+        """
+        Rewards of the episodes that were evaluated in the background since the last call
+        as (step, slot, reward), step is the step_count of the step that ended the episode
+        wait: first wait for all of the pending folds
+        """
+        self.resolve(wait)
+        rewards, self.delayed_rewards = self.delayed_rewards, []
+        return rewards
+
+    def close(self):
+        self.pending.clear()
+
+    def _get_indices(self, indices):
+        if indices is None:
+            return list(self.slots)
+        if isinstance(indices, int):
+            return [indices]
+        return list(indices)
+
+    def get_attr(self, attr_name, indices=None):
+        indices = self._get_indices(indices)
+        if attr_name in self.slot_attributes:
+            values = getattr(self, self.slot_attributes[attr_name])
+            return [values[i] for i in indices]
+        if attr_name == 'solution':
+            return [self.get_solution(i) for i in indices]
+        if attr_name in self.slot_methods:
+            return [functools.partial(getattr(self, attr_name), i) for i in indices]
+        return [getattr(self, attr_name) for _ in indices]
+
+    def set_attr(self, attr_name, value, indices=None):
+        if attr_name in self.slot_attributes:
+            values = getattr(self, self.slot_attributes[attr_name])
+            for i in self._get_indices(indices):
+                values[i] = value
+        else:
+            setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        indices = self._get_indices(indices)
+        method = getattr(self, method_name)
+        if method_name in self.slot_methods:
+            return [method(i, *method_args, **method_kwargs) for i in indices]
+        result = method(*method_args, **method_kwargs)
+        return [result for _ in indices]
+
+    def memory_usage(self):
+        return memory_usage()
+
+    def configure(self, dataset=None, dataset_key=None, config=None, next_target=False, **changes):
+        """
+        Apply a batch of changes to all of the slots (see RnaDesign.configure)
+        """
+        if dataset is not None:
+            self.dataset = remember_dataset(self.datasets, *dataset)
+        elif dataset_key is not None:
+            self.dataset = remember_dataset(self.datasets, dataset_key)
+        if config is not None:
+            self.config = {**self.config, **config}
+        for name, value in changes.items():
+            self.set_attr(name, value)
+        if next_target:
+            for slot in self.slots:
+                self.next_target_structure(slot)
+
+    def set_data(self, data):
+        self.dataset = data
+        for slot in self.slots:
+            self.current_sequences[slot] = -1
+            self.next_target_structure(slot)
+
+    def set_sequence(self, sequence):
+        self.dataset.sequences = [DotBracket(sequence, encoding_type=2)]
+        for slot in self.slots:
+            self.next_target_structure(slot)
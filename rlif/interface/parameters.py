@@ -1,13 +1,14 @@
 from PySide2 import QtWidgets, QtGui, QtCore, QtSvg
 import os, time, shutil, sys, re
 from rlif.settings import ConfigManager as config
+from rlif.rna import load_parameter_file
 import numpy as np
 import RNA
 
 def set_vienna_params(n):
 
-    params = os.path.join(config.MAIN_DIR, 'utils', 'parameters', config.param_files[n])
-    RNA.read_parameter_file(params)
+    params = os.path.join(config.PARAMETERS, config.param_files[n])
+    load_parameter_file(params)
 
 class ParameterSpinBox(QtWidgets.QWidget):
     def __init__(self, parent, parameter):
@@ -6,9 +6,9 @@ import numpy as np
 
 import rlif.environments
 from .parameters import ParameterContainer, CheckboxContainer
-from rlif.rna import Dataset, DotBracket, Solution, load_sequence
+from rlif.rna import Dataset, DotBracket, Solution, load_sequence, load_parameter_file, fold_many
 from rlif.learning import Trainer, get_parameters
-from rlif.rna import colorize_nucleotides, highlight_mismatches, colorize_motifs, load_fasta
+from rlif.rna import colorize_nucleotides, highlight_mismatches, colorize_motifs, iter_fasta
 from rlif.utils import draw, sol_draw
 from rlif.learning import RLIF
 
@@ -27,8 +27,8 @@ def set_vienna_param(param, value):
 
 def set_vienna_params(n):
 
-    params = os.path.join(config.MAIN_DIR, 'utils', 'parameters', config.param_files[n])
-    RNA.read_parameter_file(params)
+    params = os.path.join(config.PARAMETERS, config.param_files[n])
+    load_parameter_file(params)
 
 def get_icon(name):
     icon_path = os.path.join(config.ICONS, name+'.svg')
@@ -538,7 +538,6 @@ class MainWidget(QtWidgets.QWidget):
             disp = self.img_display
         else:
             if self.solution is not None:
-                self.solution.compute_statistics()
                 sequence = self.solution.centroid_structure
                 disp = self.cnt_disp
         if self.draw_mode == 0:
@@ -580,10 +579,11 @@ class MainWidget(QtWidgets.QWidget):
         conf = self.model.envs[0].config
         ext = filename.split('.')[-1]
         if ext in ['fasta', 'fa']:
-            sequences = load_fasta(filename, config=conf)
-            self.to_load = sequences[::-1]
-            self.progress_bar.setRange(0, len(sequences))
-            self.progress_bar.setValue(0)
+            # Solutions are folded in the background and added as they arrive,
+            # the bar stays busy as the number of records is only known at the end of the file
+            self.to_load = iter_fasta(filename, config=conf)
+            self.n_loaded = 0
+            self.progress_bar.setRange(0, 0)
             self.timer = QtCore.QTimer()
             self.timer.timeout.connect(self.sequential_load)
             self.timer.start(1)
@@ -596,9 +596,9 @@ class MainWidget(QtWidgets.QWidget):
                 self.target = target
                 self.update_statistics(new_target=True)
                 self.sequence_input.setText(target_string)
-                for seq in seqs[1:]:
-                    seq = seq.strip().strip('\n')
-                    seq, t, source = seq.split(' ')
+                seqs = [seq.strip().strip('\n').split(' ') for seq in seqs[1:]]
+                fold_many([seq for seq, _, _ in seqs])
+                for seq, t, source in seqs:
                     source = sources1[source]
                     # if seq != '---':
                     solution = Solution(target=target, config=conf, string=seq, time=float(t), source=source)
@@ -626,17 +626,19 @@ class MainWidget(QtWidgets.QWidget):
         """
         Workaround for non-threaded loading to keep the UI responsive
         """
-        if len(self.to_load) < 1:
+        sequence = next(self.to_load, None)
+        if sequence is None:
             self.timer.stop()
             self.timer = QtCore.QTimer()
+            self.progress_bar.setRange(0, max(self.n_loaded, 1))
+            self.progress_bar.setValue(max(self.n_loaded, 1))
         else:
-            sequence = self.to_load.pop()
             self.nucleotides = sequence.string
             self.target = sequence.target
             self.new_target(sequence.target)
             self.new_solution(sequence, color_id=self.load)
             self.update_statistics(new_target=False)
-            self.progress_bar.setValue(self.progress_bar.value()+1)
+            self.n_loaded += 1
 
     ###############
     # IO
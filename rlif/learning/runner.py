@@ -0,0 +1,60 @@
+import numpy as np
+from contextlib import contextmanager
+from stable_baselines.ppo2 import ppo2
+from stable_baselines.ppo2.ppo2 import Runner
+
+
+class AsyncRunner(Runner):
+    """
+    PPO2 rollout runner for environments that evaluate the finished episodes
+    in the background (BatchedRnaDesign with async_evaluation)
+
+    The rollout is collected without waiting for the folds, the terminal rewards are
+    then added to the steps that ended the episodes and the returns are corrected.
+    As the GAE advantages are linear in the rewards, only the difference is propagated
+    back through the episode. Environments without delayed rewards are unaffected.
+    """
+    def run(self):
+        if not hasattr(self.env, 'collect_rewards'):
+            return super().run()
+
+        start = self.env.step_count
+        obs, returns, masks, actions, values, neglogpacs, states, ep_infos, true_reward = super().run()
+
+        # Rollout arrays are flattened slot-major: [slot * n_steps + step]
+        corrections = np.zeros([self.n_envs, self.n_steps], dtype=np.float32)
+        for step, slot, reward in self.env.collect_rewards(wait=True):
+            if start <= step < start + self.n_steps:
+                corrections[slot, step - start] += reward
+        if not corrections.any():
+            return obs, returns, masks, actions, values, neglogpacs, states, ep_infos, true_reward
+
+        # Episode ended at the step (masks mark the first step of an episode)
+        ended = np.concatenate([masks.reshape(self.n_envs, self.n_steps)[:, 1:], np.reshape(self.dones, [-1, 1])], axis=1)
+        returns = returns.reshape(self.n_envs, self.n_steps).copy()
+        advantage = np.zeros(self.n_envs, dtype=np.float32)
+        for step in reversed(range(self.n_steps)):
+            advantage = corrections[:, step] + self.gamma * self.lam * (1.0 - ended[:, step]) * advantage
+            returns[:, step] += advantage
+        true_reward = true_reward + corrections.reshape(-1)
+
+        return obs, returns.reshape(-1), masks, actions, values, neglogpacs, states, ep_infos, true_reward
+
+
+@contextmanager
+def async_rollouts(env):
+    """
+    PPO2.learn collects its rollouts with AsyncRunner within the context if the env
+    evaluates the episodes in the background, other models and envs are unaffected
+
+        with async_rollouts(model.env):
+            model.learn(steps)
+    """
+    if not getattr(env, 'asynchronous', False):
+        yield
+        return
+    runner, ppo2.Runner = ppo2.Runner, AsyncRunner
+    try:
+        yield
+    finally:
+        ppo2.Runner = runner
@@ -1,4 +1,5 @@
-from rlif.rna import Dataset
+from rlif.rna import Dataset, Solution
+from rlif.environments import configure_env
 # from rlif.utils import show_rna, create_browser
 import os, datetime, sys, time
 from rlif.settings import ConfigManager as settings
@@ -57,14 +58,14 @@ class Tester(object):
             n_seqs=n_seqs, 
             encoding_type=self.wrapper.config['environment']['encoding_type'])
         
-        # Get and set attributes
-        model.env.set_attr('dataset', test_set)
-        model.env.set_attr('randomize', False)
-        model.env.set_attr('meta_learning', True)
-        model.env.set_attr('current_sequence', 0)
-        model.env.set_attr('permute', permute)
-        data = model.env.get_attr('dataset')[0]
-        get_next_target = model.env.get_attr('next_target_structure')
+        # Set attributes
+        configure_env(
+            model.env,
+            dataset=test_set,
+            randomize=False,
+            meta_learning=True,
+            current_sequence=0,
+            permute=permute)
 
         solved  = []
         t_total = 0
@@ -84,9 +85,9 @@ class Tester(object):
                 done = [False]
                 while not done[0]:
                     action, _ = model.predict(test_state)
-                    test_state, _, done, _ = model.env.step(action)
+                    test_state, _, done, infos = model.env.step(action)
 
-                solution = model.env.get_attr('prev_solution')[0]
+                solution = Solution.from_result(infos[0]['result'], target, self.wrapper.env_config)
                 target_id = solution.target.file_nr - 1
 
                 attempts[target_id] += 1
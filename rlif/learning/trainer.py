@@ -7,15 +7,18 @@ deprecation._PRINT_DEPRECATION_WARNINGS = False
 import tensorflow as tf
 import stable_baselines, gym, rlif
 from stable_baselines.common.vec_env import SubprocVecEnv, VecFrameStack, DummyVecEnv
+from stable_baselines.common.policies import RecurrentActorCriticPolicy
 import numpy as np
-import os, yaml, sys, subprocess, time, datetime, random, copy
+import os, yaml, sys, subprocess, time, datetime, random, copy, gc
 
 # Local
-from rlif.rna import DotBracket, Dataset
+from rlif.rna import DotBracket, Dataset, Solution
 from .tester import Tester
 from tqdm import tqdm
 from rlif.settings import ConfigManager as settings
+from .runner import async_rollouts
 import rlif.environments
+from rlif.environments import configure_env
 
 
 class Trainer(object):
@@ -28,6 +31,8 @@ class Trainer(object):
         self.config = None
         self.env = None
         self.test_env = None
+        self.inference_env = None # BatchedRnaDesign of batched_inverse_fold
+        self.env_config = None # Environment config with the defaults, for rebuilding the episode results
         self.model = None
         self.current_checkpoint = 0
         self.test_runner = Tester(self)
@@ -40,6 +45,7 @@ class Trainer(object):
         self._env_path = settings.TRAINED_MODELS
         self._model_path = None
         self.target = None
+        self.attempts = 0 # Attempts made by the last inverse_fold
         self.setup()
 
     def setup(self):
@@ -67,7 +73,8 @@ class Trainer(object):
             self.reloaded = True
             for _ in range(self.n_steps//evaluate_every):
                 self.model.env.set_attr('testing_mode', False)
-                self.model = self.model.learn(**config)
+                with async_rollouts(self.model.env):
+                    self.model = self.model.learn(**config)
                 self.test_runner.evaluate(self.config['testing']['test_timeout'])
                 self._save()
                 self.current_checkpoint += 1
@@ -167,10 +174,32 @@ class Trainer(object):
         Creates a corresponding vectorized environment
         """
         defaults = get_parameters('RnaDesign')['environment']
-        config = {**defaults,**self.config['environment']}
-        self.env = create_env(self.env_name, config, n_workers=self.config['main']['n_workers'])
+        config = self.env_config = {**defaults,**self.config['environment']}
+        n_workers = self.config['main']['n_workers']
+
+        # Load the dataset once, the workers share it
+        dataset = None
+        if get_env_type(self.env_name) == 'rna':
+            env_obj = getattr(rlif.environments, self.env_name)
+            if hasattr(env_obj, 'load_dataset'):
+                dataset = env_obj.load_dataset(config)
+
+        self.env = create_env(self.env_name, config, n_workers=n_workers, dataset=dataset)
         if test:
-            self.test_env = create_env(self.env_name, config, n_workers=self.config['main']['n_workers'])
+            self.test_env = create_env(self.env_name, config, n_workers=n_workers, dataset=dataset)
+        if n_workers > 1 and dataset is not None and not config.get('batched'):
+            self.memory_report()
+
+    def memory_report(self):
+        """
+        Print the resident, proportional (shared pages divided between the workers)
+        and private memory of each environment worker
+        """
+        usage = self.env.env_method('memory_usage')
+        for rank, (rss, pss, private) in enumerate(usage):
+            print('Worker {:3}: RSS {:8.1f} MB, PSS {:8.1f} MB, private {:8.1f} MB'.format(rank, rss, pss, private))
+        print('Total PSS: {:.1f} MB'.format(sum([pss for _, pss, _ in usage])))
+        return usage
 
     # Directory management
     def _create_model_dir(self):
@@ -266,22 +295,23 @@ class Trainer(object):
             self.model.set_env(self.env)
             print('EOF, Recreating environment')
 
-    def inverse_fold(self, target, solution_count=1, budget=50, permute=True, show=False, verbose=False):
+    def inverse_fold(self, target, solution_count=1, budget=50, permute=True, show=False, verbose=False, batch_size=1):
         """
         Method for using the model to generate a nucleotide sequence
         solution given a target dot-bracket sequence
+
+        With batch_size > 1 the attempts are run batch_size at a time (see batched_inverse_fold)
         """
+        if batch_size > 1 and not issubclass(self.model.policy, RecurrentActorCriticPolicy):
+            return self.batched_inverse_fold(target, solution_count, budget, batch_size, permute, show, verbose)
+
         env = self.test_env
         target = DotBracket(target, 0, 0, encoding_type=self.config['environment']['encoding_type'])
         data = Dataset(dataset='', sequences=[target])
-        env.set_attr('dataset', data)
-        env.set_attr('meta_learning', False)
-        env.set_attr('permute', permute)
-        env.set_attr('ep', 0)
-        if verbose==0: env.set_attr('verbose', False)
-        env.get_attr('next_target_structure')[0]()
+        changes = dict(meta_learning=False, permute=permute, ep=0)
+        if verbose==0: changes['verbose'] = False
+        configure_env(env, dataset=data, next_target=True, **changes)
         self.model.set_env(env)
-        target = env.get_attr('target_structure')[0]
         if show:
             driver = create_browser('double')
             show_rna(target.seq, 'AUAUAU', driver, 0)
@@ -290,7 +320,6 @@ class Trainer(object):
         solution_progress = tqdm(range(solution_count), ncols=90,position=0)
         solution_progress.set_description('Solutions: {:4}/{:4}           '.format(len(valid_solutions), solution_count))
         
-        target = self.model.env.get_attr('target_structure')[0]
         print('\nTarget length: {}, Unpaired nucleotides: {:.1f}%, structural motifs: {}'.format(target.len, target.percent_unpaired*100, target.counter),'\n', '='*120)
         try:
             num=0
@@ -306,9 +335,9 @@ class Trainer(object):
 
                     while not self.done[0]:
                         action, _ = self.model.predict(self.test_state)
-                        self.test_state, _, self.done, _ = self.model.env.step(action)
+                        self.test_state, _, self.done, infos = self.model.env.step(action)
 
-                    solution = self.model.env.get_attr('prev_solution')[0]
+                    solution = Solution.from_result(infos[0]['result'], target, self.env_config)
                     if verbose == 2: solution.summary(True)
                     if solution.hd <= 0: 
                         end = True
@@ -327,6 +356,91 @@ class Trainer(object):
 
         except KeyboardInterrupt:
             print('Stopped...')
+        self.attempts = num
+        return valid_solutions, failed_solutions
+
+    def batched_inverse_fold(self, target, solution_count=1, budget=50, batch_size=32, permute=True, show=False, verbose=False):
+        """
+        inverse_fold with batch_size attempts on the target running in lockstep in a BatchedRnaDesign:
+        a single predict call per nucleotide for all of the partial designs, the finished designs
+        are folded together (in parallel with more than one worker)
+
+        The env takes the config and boosting of test_env (as changed by prep/configure_env).
+        Every episode is charged to the first unfinished solution with budget left when it starts,
+        so each solution gets at most budget attempts and stops at the first valid design.
+        Episodes of solutions that have finished in the meantime are dropped.
+        """
+        target = DotBracket(target, 0, 0, encoding_type=self.config['environment']['encoding_type'])
+        data = Dataset(dataset='', sequences=[target])
+        config, boosting = self.test_env.get_attr('config')[0], self.test_env.get_attr('boosting')[0]
+        if self.inference_env is None or self.inference_env.num_envs != batch_size:
+            self.inference_env = rlif.environments.BatchedRnaDesign(config, n_envs=batch_size, dataset=data)
+        env = self.inference_env
+        configure_env(
+            env,
+            dataset=data,
+            config=config,
+            boosting=boosting,
+            next_target=True,
+            meta_learning=False,
+            permute=permute,
+            ep=0,
+            verbose=False)
+        if show:
+            driver = create_browser('double')
+            show_rna(target.seq, 'AUAUAU', driver, 0)
+
+        valid_solutions, failed_solutions = [], []
+        solution_progress = tqdm(total=solution_count, ncols=90, position=0)
+        solution_progress.set_description('Solutions: {:4}/{:4}           '.format(0, solution_count))
+        print('\nTarget length: {}, Unpaired nucleotides: {:.1f}%, structural motifs: {}'.format(target.len, target.percent_unpaired*100, target.counter),'\n', '='*120)
+
+        started  = [0] * solution_count # Episodes charged to each solution
+        attempts = [0] * solution_count # Evaluated attempts of each solution
+        finished = [False] * solution_count
+
+        def charge():
+            for n in range(solution_count):
+                if not finished[n] and started[n] < budget:
+                    started[n] += 1
+                    return n
+            return None
+
+        self.attempts = 0
+        state = env.reset()
+        owners = [charge() for _ in range(batch_size)]
+        try:
+            while not all(finished):
+                action, _ = self.model.predict(state)
+                state, _, _, infos = env.step(action)
+
+                ended = [slot for slot, info in enumerate(infos) if 'result' in info]
+                for slot in ended:
+                    n = owners[slot]
+                    if n is None or finished[n]:
+                        continue
+                    solution = Solution.from_result(infos[slot]['result'], target, config)
+                    self.attempts += 1
+                    attempts[n] += 1
+                    if verbose == 2: solution.summary(True)
+                    if solution.hd <= 0:
+                        if verbose == 1:
+                            solution.summary(True)
+                        valid_solutions.append(solution)
+                    else:
+                        failed_solutions.append(solution)
+                    if solution.hd <= 0 or attempts[n] == budget:
+                        finished[n] = True
+                        solution_progress.update(1)
+                    solution_progress.set_description('Solutions: {:4}/{:4}  HD: {:3}  '.format(len(valid_solutions), solution_count, solution.hd))
+                    if show: show_rna(solution.folded_structure, solution.string, driver, 1)
+                # The ended slots have started their next episodes
+                for slot in ended:
+                    owners[slot] = charge()
+
+        except KeyboardInterrupt:
+            print('Stopped...')
+        solution_progress.close()
         return valid_solutions, failed_solutions
 
     def prep(self, target=None, permute=True, verbose=False, init=False):
@@ -335,41 +449,26 @@ class Trainer(object):
         """
         # env = self.test_env
         if target is None:
-            
-            self.model.env.set_attr('meta_learning', True)
-            self.model.env.set_attr('randomize', False)
-            self.model.env.set_attr('permute', permute)
-            self.model.env.set_attr('ep', 0)
-            self.env.set_attr('meta_learning', True)
-            self.env.set_attr('randomize', False)
-            self.env.set_attr('permute', permute)
-            self.env.set_attr('ep', 0)
             self.target = target
-            config = self.env.get_attr('config')[0]
-            config['permutation_threshold'] = 15
-            config['permutation_radius'] = 5
-            config['permutation_budget'] = 15
-            config['mutation_probability'] = 0.5
-            config['allow_gu_permutations'] = True
+            config = dict(
+                permutation_threshold=15,
+                permutation_radius=5,
+                permutation_budget=15,
+                mutation_probability=0.5,
+                allow_gu_permutations=True)
             if self.env.get_attr('boosting')[0]:
                 config['boosting'] = True
-            self.env.set_attr('config', config)
-            self.model.env.set_attr('config', config)
-            if verbose==0: self.model.env.set_attr('verbose', False)
+            changes = dict(meta_learning=True, randomize=False, permute=permute, ep=0, config=config)
+            configure_env(self.env, **changes)
+            if verbose==0: changes['verbose'] = False
+            configure_env(self.model.env, **changes)
         else:
             target = DotBracket(target, 0, 0, encoding_type=self.config['environment']['encoding_type'])
             if type(target) is not list:
                 target = [target]
-            data = Dataset(sequences=target)
-            self.env.set_attr('dataset', data)
-            self.model.env.set_attr('dataset', data)
-            
-            data_fns = self.model.env.get_attr('set_data')
-            for fn in data_fns:
-                fn(data)
-            nts = self.env.get_attr('next_target_structure')
-            for nt in nts:
-                nt()
+            data = Dataset(dataset='', sequences=target)
+            for env in [self.env] if self.model.env is self.env else [self.env, self.model.env]:
+                configure_env(env, dataset=data, current_sequence=-1, next_target=True)
 
     def single_fold(self):
         """
@@ -378,12 +477,14 @@ class Trainer(object):
         
         self.test_state = self.model.env.reset()
         self.done = [False]
+        targets = self.model.env.get_attr('target_structure')
 
         while not self.done[0]:
             action, _ = self.model.predict(self.test_state)
-            self.test_state, _, self.done, _ = self.model.env.step(action)
+            self.test_state, _, self.done, infos = self.model.env.step(action)
 
-        solution = self.model.env.get_attr('prev_solution')
+        solution = [Solution.from_result(info['result'], target, self.env_config)
+                    for target, info in zip(targets, infos) if 'result' in info]
         
         return solution
 
@@ -395,19 +496,13 @@ class Trainer(object):
         env = self.test_env
         
         target = DotBracket(target, 0, 0, encoding_type=self.config['environment']['encoding_type'])
-        data = Dataset(sequences=[target])
-        env.set_attr('dataset', data)
-        env.set_attr('meta_learning', True)
-        env.set_attr('permute', permute)
-        env.set_attr('ep', 0)
-        if verbose==0: env.set_attr('verbose', False)
-        next_structures = env.get_attr('next_target_structure')
-        for next_structure in next_structures:
-            next_structure()
-        [n() for n in next_structures]
+        data = Dataset(dataset='', sequences=[target])
+        changes = dict(meta_learning=True, permute=permute, ep=0)
+        if verbose==0: changes['verbose'] = False
+        configure_env(env, dataset=data, next_target=True, **changes)
+        n_envs = env.num_envs
 
         self.model.set_env(env)
-        target = env.get_attr('target_structure')[0]
         if show:
             driver = create_browser('double')
             show_rna(target.seq, 'AUAUAU', driver, 0)
@@ -415,7 +510,7 @@ class Trainer(object):
         
         valid_solutions, failed_solutions = [], []
         solution_progress = tqdm(range(solution_count), ncols=90,position=0)
-        solution_progress.set_description('Solutions: {:4}/{:4}           '.format(len(valid_solutions), solution_count*len(next_structures)))
+        solution_progress.set_description('Solutions: {:4}/{:4}           '.format(len(valid_solutions), solution_count*n_envs))
         
         try:
             for _ in solution_progress:
@@ -429,9 +524,9 @@ class Trainer(object):
 
                     while not self.done[0]:
                         action, _ = self.model.predict(self.test_state)
-                        self.test_state, _, self.done, _ = self.model.env.step(action)
+                        self.test_state, _, self.done, infos = self.model.env.step(action)
 
-                    solutions = self.model.env.get_attr('prev_solution')
+                    solutions = [Solution.from_result(info['result'], target, self.env_config) for info in infos if 'result' in info]
                     for solution in solutions:
                         if verbose == 2: solution.summary(True)
                         if solution.hd <= 0: 
@@ -442,7 +537,7 @@ class Trainer(object):
                         else:
                             failed_solutions.append(solution)
                     attempts_progress.set_description('  Attempt: {:4}/{:4}  HD: {:3}  '.format(attempt+1,budget, solution.hd))
-                    solution_progress.set_description('Solutions: {:4}/{:4}           '.format(len(valid_solutions), solution_count*len(next_structures)))
+                    solution_progress.set_description('Solutions: {:4}/{:4}           '.format(len(valid_solutions), solution_count*n_envs))
                     if show: show_rna(solution.folded_structure, solution.string, driver, 1)
                     if end: break
                 
@@ -463,19 +558,14 @@ class Trainer(object):
             n_seqs=5000
         
         d = Dataset(dataset=dataset, start=1, n_seqs=n_seqs, encoding_type=self.config['environment']['encoding_type'])
-        self.model.env.set_attr('dataset', d)
-        self.model.env.set_attr('randomize', False)
-        self.model.env.set_attr('meta_learning', False)
-        get_seq = self.model.env.get_attr('next_target_structure')[0]
-        self.model.env.set_attr('current_sequence', 0)
-        self.model.env.set_attr('permute', permute)
+        configure_env(self.model.env, dataset=d, randomize=False, meta_learning=False, current_sequence=0, permute=permute)
 
         self.test_state = self.model.env.reset()
         solved = []
         
         for n, seq in enumerate(d.sequences):
             print(n, '\n')
-            get_seq()
+            configure_env(self.model.env, next_target=True)
             target = self.model.env.get_attr('target_structure')[0]
             if show:
                 show_rna(target.seq, 'AUAUAU', driver, 0)
@@ -486,10 +576,10 @@ class Trainer(object):
                 self.done = [False]
                 while not self.done[0]:
                     action, _ = self.model.predict(self.test_state)
-                    self.test_state, _, self.done, _ = self.model.env.step(action)
-                    solution = self.model.env.get_attr('prev_solution')[0]
+                    self.test_state, _, self.done, infos = self.model.env.step(action)
                     
                     if self.done[0]:
+                        solution = Solution.from_result(infos[0]['result'], target, self.env_config)
                         if show and ep%1==0:
                             show_rna(solution.folded_structure, solution.string, driver, 1)
                             
@@ -520,16 +610,25 @@ def get_env_type(env_name):
         except:
             return None
 
-def create_env(env_name, config=None, n_workers=1, image_based=True, **kwargs):
+def create_env(env_name, config=None, n_workers=1, image_based=True, dataset=None, **kwargs):
     """
     Parses the environment to correctly return the attributes based on the spec and type
     Creates a corresponding vectorized environment
+
+    A dataset loaded in the parent is passed to every environment: forked workers
+    share its pages copy-on-write (compiled datasets through the memory-mapped file)
+
+    With batched: true in the environment config the RnaDesign episodes are
+    stepped as arrays by a single BatchedRnaDesign instead
     """
 
     def make_rna(rank, **kwargs):
         def _init():
             env_obj = getattr(rlif.environments, env_name)
-            env = env_obj(config, rank)
+            if dataset is None:
+                env = env_obj(config, rank)
+            else:
+                env = env_obj(config, rank, dataset=dataset)
             return env
         return _init
  
@@ -550,13 +649,20 @@ def create_env(env_name, config=None, n_workers=1, image_based=True, **kwargs):
             pass
     mapping = {'gym': make_gym, 'rna':make_rna}
     env_type = get_env_type(env_name)
+
+    # All of the episodes in a single process, only the folds at the episode ends run in parallel
+    if env_type == 'rna' and config is not None and config.get('batched'):
+        return rlif.environments.BatchedRnaDesign(config, n_envs=n_workers, dataset=dataset)
     env_decorator = mapping[env_type]
     envs = [env_decorator(rank=x) for x in range(n_workers)]
 
     # Parallelize
     if n_workers > 1:
         if settings.os == 'linux':
+            # Keep the garbage collector of the workers from writing to (and copying) the shared objects
+            gc.freeze()
             vectorized = SubprocVecEnv(envs, start_method='fork')
+            gc.unfreeze()
         elif settings.os == 'win32':
             vectorized = SubprocVecEnv(envs, start_method='spawn')
     else:
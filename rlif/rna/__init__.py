@@ -1,7 +1,8 @@
 
-from .utils import load_length_metadata, load_sequence, load_fasta, write_fasta, hamming_distance
+from .utils import load_length_metadata, load_length_index, write_length_index, load_sequence, read_fasta, iter_fasta, load_fasta, write_fasta, SolutionWriter, hamming_distance, hamming_distances
 from .utils import colorize_nucleotides, highlight_mismatches, colorize_motifs
 from .dotbracket import DotBracket
-from .dataset import Dataset
-from .vienna  import fold, set_vienna_params
-from .solution import Solution
+from .dataset import Dataset, CompiledDataset, compile_dataset
+from .vienna  import fold, set_vienna_params, load_parameter_file, FoldCache, fold_cache, fold_many
+from .vienna  import ParameterSet, get_parameter_set, fold_sweep, fold_stream, EvaluationContext
+from .solution import Solution, EpisodeResult
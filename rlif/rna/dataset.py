@@ -1,10 +1,158 @@
 import numpy as np
-import os, random, yaml, time
-from rlif.rna import load_length_metadata, load_sequence
+import os, random, yaml, time, json, argparse, hashlib
+from rlif.rna import load_length_metadata, load_sequence, write_length_index
+from rlif.rna.utils import length_query
 from rlif.rna import DotBracket
+from rlif.rna.dotbracket import ParsedStructure
 from rlif.settings import ConfigManager as settings
 from rlif.rna import load_fasta
 
+# Layout of a compiled dataset file:
+#   magic | header size (uint64) | JSON header | arrays aligned to ALIGNMENT bytes
+# The header maps each array name to its dtype, shape and offset in the file
+MAGIC = b'RLIFDS01'
+ALIGNMENT = 64
+MOTIF_COUNTS = ['M', 'H', 'I', 'E']
+
+def compiled_path(dataset):
+    return os.path.join(settings.DATA, 'metadata', '{}.rds'.format(dataset))
+
+def compile_dataset(dataset, path=None):
+    """
+    Pack all of the data/<dataset>/<n>.rna targets into a single binary file:
+    concatenated dot-brackets, offsets, pair tables, structural motifs, motif counts
+    and the length index (record indices sorted by length).
+    Has to be rerun when the dataset changes.
+    """
+    directory = os.path.join(settings.DATA, dataset)
+    file_nrs = sorted([int(name[:-4]) for name in os.listdir(directory)
+                       if name.endswith('.rna') and name[:-4].isdigit()])
+    targets = [load_sequence(num, dataset=dataset) for num in file_nrs]
+    lengths = np.array([target.len for target in targets], dtype=np.int32)
+
+    arrays = dict(
+        file_nrs=np.array(file_nrs, dtype=np.int32),
+        offsets=np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+        lengths=lengths,
+        length_order=np.argsort(lengths, kind='stable').astype(np.int32),
+        structures=np.frombuffer(''.join([t.seq for t in targets]).encode(), dtype=np.uint8),
+        motifs=np.frombuffer(''.join([t.struct_motifs for t in targets]).encode(), dtype=np.uint8),
+        pair_tables=np.concatenate([t.pair_table for t in targets]).astype(np.int32),
+        counters=np.array([[t.counter[m] for m in MOTIF_COUNTS] for t in targets], dtype=np.int32).reshape(-1, 4))
+
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset += aligned(array.nbytes)
+    header = json.dumps(dict(dataset=dataset, arrays=layout)).encode()
+    start = aligned(len(MAGIC) + 8 + len(header))
+
+    path = compiled_path(dataset) if path is None else path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(MAGIC + np.uint64(len(header)).tobytes() + header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name][2])
+            f.write(array.tobytes())
+    print('\nCompiled {} targets of {} into {}'.format(len(targets), dataset, path))
+    return path
+
+def aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+class CompiledDataset(object):
+    """
+    Memory-mapped compiled dataset (see compile_dataset)
+    Arrays are views into the mapped file, so opening it only reads the header
+    """
+    def __init__(self, dataset=None, path=None):
+        self.path = compiled_path(dataset) if path is None else path
+        self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError('{} is not a compiled dataset.'.format(self.path))
+        size = int(self.data[len(MAGIC):len(MAGIC)+8].view(np.uint64)[0])
+        header_end = len(MAGIC) + 8 + size
+        header = json.loads(bytes(self.data[len(MAGIC)+8:header_end]).decode())
+        start = aligned(header_end)
+
+        self.dataset = header['dataset']
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            array = self.data[start+offset:start+offset+nbytes].view(dtype).reshape(shape)
+            setattr(self, name, array)
+
+    def __getstate__(self):
+        # Reopen the file instead of copying the mapped arrays
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        self.__init__(path=state['path'])
+
+    def __len__(self):
+        return len(self.file_nrs)
+
+    def length_records(self, low, high=None, limit=None):
+        """
+        Record indices of the targets with low <= length < high (see length_query)
+        """
+        return self.length_order[length_query(self.lengths[self.length_order], low, high, limit)]
+
+    def records(self, file_nrs):
+        """
+        Record indices of the existing file numbers
+        """
+        file_nrs = np.asarray(file_nrs)
+        index = np.searchsorted(self.file_nrs, file_nrs).clip(0, max(len(self) - 1, 0))
+        return index[self.file_nrs[index] == file_nrs]
+
+    def target(self, record, encoding_type=2):
+        """
+        DotBracket of a record, built from the precomputed parse
+        """
+        start, end = self.offsets[record], self.offsets[record+1]
+        file_nr = int(self.file_nrs[record])
+        counter = dict(zip(MOTIF_COUNTS, self.counters[record].tolist()))
+        parsed = ParsedStructure(self.pair_tables[start:end], bytes(self.motifs[start:end]).decode(), counter)
+        return DotBracket(
+            bytes(self.structures[start:end]).decode(),
+            os.path.join(settings.DATA, self.dataset, '{}.rna'.format(file_nr)),
+            file_nr,
+            encoding_type=encoding_type,
+            parsed=parsed)
+
+
+class DotBracketViews(object):
+    """
+    List-like selection of records of a compiled dataset
+    The DotBracket of a record is built on first access and kept
+    """
+    def __init__(self, compiled, records, encoding_type=2):
+        self.compiled = compiled
+        self.records = np.asarray(records, dtype=np.int64)
+        self.encoding_type = encoding_type
+        self.targets = [None] * len(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        target = self.targets[index]
+        if target is None:
+            target = self.targets[index] = self.compiled.target(self.records[index], self.encoding_type)
+        return target
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def lengths(self):
+        return self.compiled.lengths[self.records]
+
 class Dataset(object):
     """
     TODO:
@@ -17,7 +165,8 @@ class Dataset(object):
             start=1,
             n_seqs=100,
             sequences=None,
-            encoding_type=2):
+            encoding_type=2,
+            compiled=True):
 
         self.dataset = dataset
         self.path = os.path.join(settings.DATA, dataset)
@@ -27,19 +176,29 @@ class Dataset(object):
             solutions = load_fasta(settings.test_config)
             self.sequences = [solution.target for solution in solutions]
 
+        # Lazy views into the compiled dataset file if there is one
+        elif sequences is None and compiled and os.path.isfile(compiled_path(dataset)):
+            data = CompiledDataset(dataset)
+            if length is None:
+                records = data.records(np.arange(start, start+n_seqs))
+            elif isinstance(length, int):
+                records = data.length_records(length, limit=n_seqs)
+            elif len(length) <= 2:
+                records = data.length_records(length[0], length[1], limit=n_seqs)
+            else:
+                records = np.concatenate([data.length_records(l, limit=n_seqs) for l in length])
+            self.sequences = DotBracketViews(data, records, encoding_type)
+
         else:
             # Load sequences of specific length only
             if length is not None:
                 if isinstance(length, int):
-                    sequence_file_numbers = load_length_metadata(dataset, length)
-                    self.sequences = [load_sequence(index, dataset=dataset, encoding_type=encoding_type) for index in sequence_file_numbers[:n_seqs]]
-                if isinstance(length, list):
-                    if len(length) <= 2:
-                        length = range(length[0], length[1])
-                    self.sequences = []
-                    for l in length:
-                        sequence_file_numbers = load_length_metadata(dataset, l)    
-                        self.sequences += [load_sequence(index, dataset=dataset, encoding_type=encoding_type) for index in sequence_file_numbers[:n_seqs]]
+                    sequence_file_numbers = load_length_metadata(dataset, length, limit=n_seqs)
+                elif len(length) <= 2:
+                    sequence_file_numbers = load_length_metadata(dataset, length[0], length[1], limit=n_seqs)
+                else:
+                    sequence_file_numbers = sum([load_length_metadata(dataset, l, limit=n_seqs) for l in length], [])
+                self.sequences = [load_sequence(index, dataset=dataset, encoding_type=encoding_type) for index in sequence_file_numbers]
             # Create dataset from a list of sequences loaded elsewhere
             if sequences is not None:
                 self.sequences = sequences
@@ -57,6 +216,21 @@ class Dataset(object):
     def __getitem__(self, index):
         return self.sequences[index]
 
+    def key(self):
+        """
+        Content hash of the targets (file numbers, dot-brackets and encodings)
+        Environments keep the datasets they have received under it (see configure)
+        """
+        digest = hashlib.md5()
+        if isinstance(self.sequences, DotBracketViews):
+            views = self.sequences
+            digest.update('{} {}\n'.format(os.path.abspath(views.compiled.path), views.encoding_type).encode())
+            digest.update(views.records.tobytes())
+        else:
+            for target in self.sequences:
+                digest.update('{} {} {}\n'.format(target.file_nr, target.encoding_type, target.seq).encode())
+        return digest.hexdigest()
+
     def visualize(self, auto=False):
         """
         Call the forna container and visualize the dataset
@@ -68,35 +242,33 @@ class Dataset(object):
             if not auto: input()
             else: time.sleep(2)
 
+    def lengths(self):
+        if isinstance(self.sequences, DotBracketViews):
+            return self.sequences.lengths
+        return [seq.len for seq in self.sequences]
+
     def statistics(self):
-        avg_length = np.mean([seq.len for seq in self.sequences])
+        avg_length = np.mean(self.lengths())
         msg = 'Sequences: {}\n'.format(len(self.sequences))+ \
               'Average length: {}\n'.format(avg_length)
         return msg
     
     def length_distribution(self, bins=50):
-        lengths = [seq.len for seq in self.sequences]
+        lengths = self.lengths()
         plt.hist(lengths, bins=bins, histtype='bar', ec='black', alpha=0.5, color='r')
         plt.ylabel('Number of sequences')
         plt.xlabel('DotBracket length')
         plt.show()
 
-    def length_grouping(self):
+    def build_length_index(self):
         """
-        Write metadata about sequence lengths for faster loading in the future
+        Write the length index of the dataset for faster loading by length in the future
         """
         lengths = {}
         for seq in self.sequences:
             if seq.len not in lengths.keys(): lengths[seq.len] = []
             lengths[seq.len].append(seq.file_nr)
-
-        for length in lengths.keys():
-            dirname = os.path.join(settings.DATA, 'metadata', self.dataset, 'len')
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname)
-            filename = os.path.join(dirname, '{}.yml'.format(length))
-            with open(filename, 'w') as f:
-                yaml.dump(lengths[length], f)
+        write_length_index(self.dataset, lengths)
         return lengths
 
     def create_subgraph_dataset(self, name):
@@ -119,6 +291,9 @@ class Dataset(object):
 
                 sequence.get_subgraph()
 
-
-
-
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile datasets into memory-mapped binary files')
+    parser.add_argument('datasets', nargs='+', type=str)
+    args = parser.parse_args()
+    for dataset in args.datasets:
+        compile_dataset(dataset)
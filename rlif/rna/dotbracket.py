@@ -1,31 +1,313 @@
 import numpy as np
 import forgi, math
+from collections import namedtuple
+
+# Structural motif of a run of dots from the brackets around it (X = end of the structure)
+MOTIFS = {'()':'H', ')(':'M', '((':'I', '))':'I', 'X(':'E', ')X':'E', 'XX':'E'}
+MOTIF_LUT = np.zeros([256, 256], dtype=np.uint8)
+for _pair, _motif in MOTIFS.items():
+    MOTIF_LUT[ord(_pair[0]), ord(_pair[1])] = ord(_motif)
+COUNTED_MOTIFS = 'MHIE'
+COUNTER_LUT = np.zeros(256, dtype=np.int64)
+for _i, _motif in enumerate(COUNTED_MOTIFS):
+    COUNTER_LUT[ord(_motif)] = _i
+
+# Row of each symbol in the one-hot encodings (255 = not encoded)
+ENCODINGS = {
+    0: ({'.': 0, '(':1, ')':1}, 2, False),
+    1: ({'.': 0, '(':1, ')':2}, 3, False),
+    2: ({'O': 0, 'C': 1, 'I': 2, 'H': 3, 'M':4, 'E':5}, 6, True),
+    3: ({'O': 0, 'C': 0, 'I': 1, 'H': 2, 'M':3, 'E':3}, 4, True)}
+ENCODING_LUTS = {}
+for _type, (_mapping, _rows, _motifs) in ENCODINGS.items():
+    ENCODING_LUTS[_type] = np.full(256, 255, dtype=np.uint8)
+    for _symbol, _row in _mapping.items():
+        ENCODING_LUTS[_type][ord(_symbol)] = _row
+
+# Result of parsing a dot-bracket string, the optional fields are derived by DotBracket if missing
+ParsedStructure = namedtuple(
+    'ParsedStructure',
+    ['pair_table', 'motifs', 'counter', 'loops', 'base_pairs', 'encoding'],
+    defaults=[None, None, None])
+
+def parse_structures(structures, encoding_type=None):
+    """
+    Parse many dot-bracket strings in a single vectorized pass
+
+    The structures are concatenated as X + s1 + X + s2 + ... + X, so that the
+    separators act as the ends of each structure. Brackets are matched per
+    structure and nesting depth, runs of dots are assigned the motif of the
+    brackets around them and openings/closings are marked O/C.
+
+    Returns a ParsedStructure per structure (with the one-hot structure encoding
+    if the encoding type is given), or None for the structures that the separate DotBracket passes do not accept
+    either (characters other than '.()', dots without a motif)
+    """
+    if len(structures) == 0:
+        return []
+    buffer = np.frombuffer(('X' + 'X'.join(structures) + 'X').encode(), dtype=np.uint8)
+    n = len(buffer)
+    index = np.arange(n)
+    separators = np.flatnonzero(buffer == 88)
+    segment = np.cumsum(buffer == 88) - 1
+    starts = separators[:-1] + 1
+    start = np.append(starts, n)[segment]
+    is_open, is_close, is_dot = buffer == 40, buffer == 41, buffer == 46
+    supported = np.logical_and.reduceat(is_open | is_close | is_dot | (buffer == 88), separators[:-1])
+
+    # Nesting depth within each structure, pairing stops at an unmatched closing bracket
+    depth = np.cumsum(is_open.astype(np.int64) - is_close)
+    depth -= depth[separators][segment]
+    first_unmatched = np.minimum.reduceat(np.where(depth < 0, index, n), separators)
+    valid = index < first_unmatched[segment]
+
+    # Openings and closings of the same depth alternate, match them pairwise
+    brackets = np.flatnonzero((is_open | is_close) & valid)
+    level = depth[brackets] + is_close[brackets]
+    brackets = brackets[np.lexsort((brackets, level, segment[brackets]))]
+    closing = np.flatnonzero(is_close[brackets])
+    partners = np.full(n, -1, dtype=np.int64)
+    partners[brackets[closing - 1]] = brackets[closing]
+    partners[brackets[closing]] = brackets[closing - 1]
+    pair_tables = np.where(partners >= 0, partners - start, -1).astype(np.int32)
+
+    # Hairpin loops: a closing bracket right after an opening one (ignoring dots),
+    # excluding the last position
+    all_brackets = np.flatnonzero(is_open | is_close)
+    hairpin = np.flatnonzero(
+        is_close[all_brackets[1:]] & is_open[all_brackets[:-1]] & (buffer[all_brackets[1:] + 1] != 88)) + 1
+    loop_ends = all_brackets[hairpin]
+    loop_starts = all_brackets[hairpin - 1]
+    same = segment[loop_starts] == segment[loop_ends]
+    loop_starts, loop_ends = loop_starts[same], loop_ends[same]
+
+    # Motifs of the dots from the nearest brackets/ends on both sides
+    structural = ~is_dot
+    previous = np.maximum.accumulate(np.where(structural, index, 0))
+    following = np.minimum.accumulate(np.where(structural, index, n - 1)[::-1])[::-1]
+    motifs = MOTIF_LUT[buffer[previous], buffer[following]]
+    motifs[is_open], motifs[is_close] = 79, 67
+
+    # Motif counts: every run of dots except the one at the end, which is
+    # counted once per structure along with the end of the structure itself
+    # Runs of dots between brackets without a motif (e.g. X) or (X) are not parsed here
+    ends = MOTIF_LUT[buffer[previous[separators[1:] - 1]], 88]
+    supported &= (ends > 0) & ~np.logical_or.reduceat(is_dot & (motifs == 0), separators[:-1])
+    runs = np.flatnonzero(is_dot & ~np.append(False, is_dot[:-1]))
+    runs = runs[buffer[following[runs]] != 88]
+    counts = np.bincount(
+        segment[runs] * 4 + COUNTER_LUT[motifs[runs]], minlength=len(structures) * 4).reshape(-1, 4)
+    counts[:, 3] += 1
+
+    # One-hot encodings of all of the structures at once
+    encodings = None
+    if encoding_type in ENCODINGS:
+        _, rows, use_motifs = ENCODINGS[encoding_type]
+        codes = ENCODING_LUTS[encoding_type][motifs if use_motifs else buffer]
+        encodings = (codes == np.arange(rows, dtype=np.uint8)[:, np.newaxis]).view(np.uint8)
+
+    # Split into Python lists per structure, base pairs in the order of the closing brackets
+    loop_bounds = np.searchsorted(segment[loop_starts], np.arange(len(structures) + 1)).tolist()
+    loops = np.stack([loop_starts - start[loop_starts], loop_ends - start[loop_ends]], axis=1).tolist()
+    closings = brackets[closing]
+    order = np.argsort(closings)
+    closings, openings = closings[order], brackets[closing - 1][order]
+    pair_bounds = np.searchsorted(closings, separators).tolist()
+    closings, openings = (closings - start[closings]).tolist(), (openings - start[openings]).tolist()
+    counts = counts.tolist()
+    motif_string = motifs.tobytes().decode()
+
+    parsed = []
+    for k, structure in enumerate(structures):
+        if not supported[k]:
+            parsed.append(None)
+            continue
+        begin, end = starts[k], starts[k] + len(structure)
+        if first_unmatched[k] < end:
+            print('Number of opening and closing brackets does not match.')
+        first, last = pair_bounds[k], pair_bounds[k+1]
+        parsed.append(ParsedStructure(
+            pair_tables[begin:end],
+            motif_string[begin:end],
+            dict(zip(COUNTED_MOTIFS, counts[k])),
+            loops[loop_bounds[k]:loop_bounds[k+1]],
+            dict(zip(openings[first:last], closings[first:last])),
+            None if encodings is None else encodings[:, begin:end].copy()))
+    return parsed
+
+def parse_dotbracket(structure):
+    """
+    Parse a single dot-bracket string in one pass, same output as parse_structures
+    """
+    length = len(structure)
+    pair_table, markers = [-1] * length, ['N'] * length
+    counter = dict(M=0, H=0, I=0, E=0)
+    loops, stack, pairs = [], [], {}
+    previous, run, opening, unmatched = 'X', 0, False, False
+    for i, symbol in enumerate(structure):
+        if symbol == '.':
+            run += 1
+            continue
+        if symbol == '(':
+            stack.append(i)
+            opening, last_opening = True, i
+            markers[i] = 'O'
+        elif symbol == ')':
+            if opening and i < length - 1:
+                loops.append([last_opening, i])
+            opening = False
+            if not unmatched:
+                if stack:
+                    j = stack.pop()
+                    pair_table[i], pair_table[j] = j, i
+                    pairs[j] = i
+                else:
+                    unmatched = True
+            markers[i] = 'C'
+        else:
+            return None
+        if run > 0:
+            motif = MOTIFS.get(previous + symbol)
+            if motif is None:
+                return None
+            markers[i-run:i] = motif * run
+            counter[motif] += 1
+            run = 0
+        previous = symbol
+
+    motif = MOTIFS.get(previous + 'X')
+    if motif is None:
+        return None
+    markers[length-run:] = motif * run
+    counter[motif] += 1
+    if unmatched:
+        print('Number of opening and closing brackets does not match.')
+    return ParsedStructure(pair_table, ''.join(markers), counter, loops, pairs)
+
+def parse_many(structures, encoding_type=2):
+    """
+    DotBracket objects of many dot-bracket strings, parsed together (see parse_structures)
+    """
+    structures = list(structures)
+    parsed = parse_structures(structures, encoding_type)
+    return [DotBracket(structure, encoding_type=encoding_type, parsed=parse if parse is not None else False)
+            for structure, parse in zip(structures, parsed)]
+
 
 class DotBracket(object):
     """
     Container for dot-bracket annotated RNA secondary structure sequences
     Contains methods for preprocessing, etc.
     """
-    def __init__(self, sequence, file_id=None, file_nr=None, encoding_type=2, graph_based=False):
+    def __init__(self, sequence, file_id=None, file_nr=None, encoding_type=2, graph_based=False, parsed=None):
         self.encoding_type = encoding_type
         self.file_nr = file_nr
         self.file_id = file_id
         self.seq = sequence
         self.len = len(sequence)
+        self.seq_array = np.frombuffer(sequence.encode(), dtype=np.uint8) # ASCII codes
         self.nucleotides = None
         self.name = ''
-
-        # Parse
-        self.loops = self._count_loops()
-        self.base_pair_indices = self.find_base_pairs()
+        self.visited = None # Tabu memo of the permutation search: (parameter key, sequences)
+        self.templates = {} # Padded encodings keyed by (kernel_size, use_nucleotides)
+        self._graph = None # forgi graph and boosting plan, built on first use
+        self._boosting_plan = None
+
+        # Parse in a single pass, or reuse a ParsedStructure of parse_many / a compiled dataset
+        # parsed=False or unsupported structures: separate passes over the string
+        if parsed is None:
+            parsed = parse_dotbracket(sequence)
+        if not parsed:
+            self.loops = self._count_loops()
+            self.base_pair_indices = self.find_base_pairs()
+            self.struct_motifs, self.counter = self.parse_structure()
+            pair_table = None
+        else:
+            self.struct_motifs, self.counter = parsed.motifs, parsed.counter
+            self.loops = self._count_loops() if parsed.loops is None else parsed.loops
+            pair_table = np.array(parsed.pair_table, dtype=np.int32)
+            if parsed.base_pairs is None:
+                # Keyed in the order of the closing brackets, as find_base_pairs
+                closing = np.flatnonzero((pair_table >= 0) & (pair_table < np.arange(self.len)))
+                self.base_pair_indices = dict(zip(pair_table[closing].tolist(), closing.tolist()))
+            else:
+                self.base_pair_indices = parsed.base_pairs
         self.rev_base_pair_indices = {v: k for k, v in self.base_pair_indices.items()}
-        self.struct_motifs, self.counter = self.parse_structure()
-        self.structure_encoding = self.to_matrix()
-        self.percent_unpaired = float(sum([1 if x == '.' else 0 for x in self.seq])) / self.len
+        self.pair_table, self.schedule = self.fill_schedule(pair_table)
+        self.episode_length = len(self.schedule)
+        # Python int copies for the per-step lookups (indexing numpy scalars is slower)
+        self.pair_list, self.schedule_list = self.pair_table.tolist(), self.schedule.tolist()
+        if parsed and parsed.encoding is not None:
+            self.structure_encoding = parsed.encoding
+        else:
+            self.structure_encoding = self.to_matrix()
+        self.percent_unpaired = float(self.seq.count('.')) / self.len
         
     def __repr__(self):
         return self.seq
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_graph'] = None # Rebuilt on demand, much larger than the plan
+        state['visited'] = None # Up to FOLD_CACHE_SIZE sequences, local to the process
+        return state
+
+    @property
+    def graph(self):
+        """
+        forgi graph of the structure, loaded once per target
+        """
+        if self._graph is None:
+            self._graph, = forgi.load_rna(self.seq)
+        return self._graph
+
+    @property
+    def boosting_plan(self):
+        """
+        0-based positions of the loop nucleotides rewritten by Solution.boost,
+        compiled once from the forgi graph:
+
+        interior: (dims, positions) per interior loop in the order of iloop_iterator,
+                  only for the (1, 1), (2, 1), (2, 2) and (>2, >2) loops
+        hairpins: (first, last) per hairpin in the order of hloop_iterator,
+                  None for hairpins of 3 nucleotides or less
+        """
+        if self._boosting_plan is None:
+            graph = self.graph
+            interior = []
+            for i in graph.iloop_iterator():
+                dims = graph.get_node_dimensions(i)
+                indices = graph.elements_to_nucleotides([i])
+                strand1 = indices[:dims[0]]
+                strand2 = indices[-dims[1]:]
+                if dims[1] > dims[0]:
+                    strand1, strand2 = strand2, strand1
+                dims = (max(dims), min(dims))
+
+                if dims == (1, 1):
+                    positions = (strand1[0], strand2[-1])
+                elif dims == (2, 1):
+                    positions = (strand1[0], strand1[1], strand2[0])
+                elif dims == (2, 2):
+                    positions = (strand1[0], strand1[1], strand2[0], strand2[1])
+                elif dims[0] > 2 and dims[1] > 2:
+                    positions = (strand1[0], strand1[1], strand2[1], strand2[0])
+                    dims = (3, 3)
+                else:
+                    continue
+                interior.append((dims, tuple(p - 1 for p in positions)))
+
+            hairpins = []
+            for h in graph.hloop_iterator():
+                indices = graph.elements_to_nucleotides([h])
+                if len(indices) > 3:
+                    strand1 = indices[:graph.get_node_dimensions(h)[0]]
+                    hairpins.append((strand1[0] - 1, strand1[-1] - 1))
+                else:
+                    hairpins.append(None)
+            self._boosting_plan = interior, hairpins
+        return self._boosting_plan
+
     def summary(self):
         msg = 'Seq: {:5}, Len: {:4}, DBR: {:.2f}, Loops: {:3}'.format(self.file_id, self.len, self.percent_unpaired, len(self.loops))
         return(msg)
@@ -47,28 +329,17 @@ class DotBracket(object):
         0011000000 <---`
         0000001100
         """
-        # Dots and brackets only
-        if self.encoding_type == 0:
-            mapping = {'.': 0, '(':1, ')':1}
-            template = self.seq
-            rows = 2
-
-        if self.encoding_type == 1:
-            mapping = {'.': 0, '(':1, ')':2}
-            template = self.seq
-            rows = 3
-
-        # Openings, closings, internal loops, next_hairpin loops, multiloops, ends
-        if self.encoding_type == 2:
-            mapping = {'O': 0, 'C': 1, 'I': 2, 'H': 3, 'M':4, 'E':5}
-            template = self.struct_motifs
-            rows = 6
-        
-        # Brackets, internal loops, next_hairpin loops, multiloops
-        if self.encoding_type == 3:
-            mapping = {'O': 0, 'C': 0, 'I': 1, 'H': 2, 'M':3, 'E':3}
-            template = self.struct_motifs
-            rows = 4
+        # 0: Dots and brackets only
+        # 1: Dots, openings and closings
+        # 2: Openings, closings, internal loops, next_hairpin loops, multiloops, ends
+        # 3: Brackets, internal loops, next_hairpin loops, multiloops
+        if self.encoding_type in ENCODINGS:
+            mapping, rows, use_motifs = ENCODINGS[self.encoding_type]
+            template = self.struct_motifs if use_motifs else self.seq
+            codes = ENCODING_LUTS[self.encoding_type][np.frombuffer(template.encode(), dtype=np.uint8)]
+            if self.len > 0 and codes.max() == 255:
+                raise KeyError(template[int(np.argmax(codes == 255))])
+            return (codes == np.arange(rows, dtype=np.uint8)[:, np.newaxis]).view(np.uint8)
         
         # Multidiscrete encoding
         if self.encoding_type == 4:
@@ -83,13 +354,41 @@ class DotBracket(object):
                                  [mapping[self.struct_motifs[x-1]] if x!=0 else 0 for x in self.strand2]])
             return encoding
 
-        # Create a one-hot encoding
-        encoding = np.zeros([rows, self.len])
-        for index in range(self.len):
-            element = template[index]
-            encoding[mapping[element], index] = 1
+        raise ValueError('Unknown encoding type: {}'.format(self.encoding_type))
+
+    def padded_encoding(self, kernel_size, use_nucleotides=False):
+        """
+        Structure encoding padded with kernel_size zero columns on both sides,
+        with 4 empty nucleotide rows appended if use_nucleotides
+
+        Built once per layout and returned read-only, solutions copy it
+        """
+        key = (kernel_size, bool(use_nucleotides))
+        template = self.templates.get(key)
+        if template is None:
+            rows, length = self.structure_encoding.shape
+            total_rows = rows + 4 if use_nucleotides else rows
+            template = np.zeros([total_rows, length + kernel_size * 2], dtype=np.uint8)
+            template[:rows, kernel_size:kernel_size+length] = self.structure_encoding
+            template.flags.writeable = False
+            self.templates[key] = template
+        return template
+
+    def fill_schedule(self, pair_table=None):
+        """
+        Pair table (index of the paired nucleotide or -1) and the order
+        in which the nucleotides are filled in during an episode:
+        every position that is not the closing bracket of a base pair,
+        followed by the last position, which always ends the episode
+        """
+        if pair_table is None:
+            pair_table = np.full(self.len, -1, dtype=np.int32)
+            for i, j in self.base_pair_indices.items():
+                pair_table[i], pair_table[j] = j, i
 
-        return encoding
+        unpaired_or_opening = (pair_table == -1) | (pair_table > np.arange(self.len, dtype=np.int32))
+        unpaired_or_opening[-1] = True
+        return pair_table, np.flatnonzero(unpaired_or_opening).astype(np.int32)
 
     def find_base_pairs(self):
         """
@@ -217,7 +516,7 @@ class DotBracket(object):
         """
         
         strand_dict = {}
-        graph, = forgi.load_rna(self.seq)
+        graph = self.graph
         for element, indices in graph.defines.items():
             dimensions = list(graph.get_node_dimensions(element))
             if dimensions[1] == 1000 or dimensions[1] == -1:
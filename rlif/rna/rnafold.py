@@ -0,0 +1,206 @@
+import os, subprocess, threading, queue
+from concurrent.futures import ThreadPoolExecutor
+from rlif.settings import ConfigManager as settings
+
+# Record written after every batch so that the last real record is never held back
+# by RNAfold waiting for the next FASTA header
+FLUSH_HEADER = '>rlif_flush'
+FLUSH_RECORD = FLUSH_HEADER + '\nA\n'
+
+
+class RNAfoldError(Exception):
+    pass
+
+
+def rnafold_command(executable=None, options=None, parameters=None):
+    """
+    Command line of a streaming RNAfold process using the parameter set
+    or the active Vienna parameters
+    """
+    from rlif.rna.vienna import vienna_key, model_options, MODEL_DETAILS
+    executable = settings.rnafold if executable is None else executable
+    command = [executable, '--noPS']
+    if options is None and parameters is not None:
+        options = parameters.rnafold_options()
+    if options is None:
+        key = vienna_key()
+        options = model_options(dict(zip(MODEL_DETAILS, key[1:])))
+        if key[0] is not None:
+            options += ['-P', key[0]]
+    return command + list(options)
+
+
+def parse_structure_line(line):
+    """
+    '((((....)))) ( -5.40)' -> ('((((....))))', -5.4)
+    """
+    structure, energy = line.rstrip().split(' ', 1)
+    try:
+        energy = float(energy.strip().strip('()'))
+    except ValueError:
+        energy = 0.
+    return structure, energy
+
+
+class RNAfoldWorker(object):
+    """
+    A single long-lived RNAfold process reading FASTA records from stdin
+    """
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.restarts = 0
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            bufsize=1)
+
+    def restart(self):
+        self.close()
+        self.restarts += 1
+        self.start()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def _write(self, request, errors):
+        try:
+            self.process.stdin.write(request)
+            self.process.stdin.flush()
+        except (OSError, ValueError) as e:
+            errors.append(e)
+
+    def fold(self, sequences):
+        """
+        Fold a batch of sequences in a single round trip
+        The request is written from a separate thread so that large batches
+        cannot deadlock on full pipe buffers
+        """
+        if not self.alive():
+            self.restart()
+        request = ''.join(['>{}\n{}\n'.format(i, seq) for i, seq in enumerate(sequences)]) + FLUSH_RECORD
+        errors = []
+        writer = threading.Thread(target=self._write, args=(request, errors))
+        writer.daemon = True
+        writer.start()
+
+        stdout = self.process.stdout
+        results = [None] * len(sequences)
+        remaining = len(sequences)
+        while remaining > 0:
+            header = stdout.readline()
+            if header == '':
+                raise RNAfoldError('RNAfold process exited (return code {}).'.format(self.process.poll()))
+            header = header.strip()
+            if not header.startswith('>'):
+                continue
+            stdout.readline() # Sequence echo
+            line = stdout.readline()
+            if line == '':
+                raise RNAfoldError('RNAfold process exited (return code {}).'.format(self.process.poll()))
+            if header == FLUSH_HEADER:
+                continue
+            results[int(header[1:])] = parse_structure_line(line)
+            remaining -= 1
+
+        writer.join()
+        if errors:
+            raise RNAfoldError(errors[0])
+        return results
+
+
+class RNAfoldPool(object):
+    """
+    Pool of persistent RNAfold processes
+
+    Sequences are streamed over stdin in chunks and the structures/free energies
+    are read back from stdout, so the process startup cost is paid only once.
+    Crashed workers are restarted and their chunk is resubmitted.
+
+    Can be used as the folding function:
+        settings.fold_fn = RNAfoldPool(n_workers=4)
+    """
+    def __init__(self, n_workers=None, executable=None, options=None, chunk_size=64, max_retries=2, parameters=None):
+        self.n_workers = settings.WORKERS if n_workers is None else n_workers
+        self.command = rnafold_command(executable, options, parameters)
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.workers = [RNAfoldWorker(self.command) for _ in range(self.n_workers)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.executor = ThreadPoolExecutor(max_workers=self.n_workers)
+
+    def __call__(self, sequence):
+        return self.fold_many([sequence])[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def restarts(self):
+        return sum([worker.restarts for worker in self.workers])
+
+    def _fold_chunk(self, chunk):
+        worker = self.idle.get()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return worker.fold(chunk)
+                except (RNAfoldError, OSError, ValueError):
+                    if attempt >= self.max_retries:
+                        raise
+                    attempt += 1
+                    worker.restart()
+        finally:
+            self.idle.put(worker)
+
+    def fold_many(self, sequences):
+        """
+        Fold a list of sequences, results are returned in input order
+        """
+        sequences = list(sequences)
+        if len(sequences) == 0:
+            return []
+        size = self.chunk_size
+        if self.n_workers > 1:
+            # Spread small batches over all of the workers
+            size = max(1, min(size, -(-len(sequences) // self.n_workers)))
+        chunks = [sequences[i:i+size] for i in range(0, len(sequences), size)]
+        if len(chunks) == 1:
+            return self._fold_chunk(chunks[0])
+
+        results = []
+        for folded in self.executor.map(self._fold_chunk, chunks):
+            results += folded
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for worker in self.workers:
+            worker.close()
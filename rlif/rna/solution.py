@@ -1,51 +1,144 @@
 import numpy as np
-import copy, random, os, datetime, sys, forgi
+import copy, random, os, datetime, sys
 import time as t
+from collections import namedtuple
 from rlif.settings import ConfigManager as settings
-from rlif.rna import DotBracket, hamming_distance
+from rlif.rna import DotBracket, hamming_distance, hamming_distances
 from rlif.rna import colorize_nucleotides, highlight_mismatches
+from rlif.rna.utils import SolutionWriter
+from rlif.rna.vienna import fold_cache, fold_many, get_parameter_set, vienna_key, EvaluationContext
 
-fold_fn = settings.fold_fn
+fold_fn = fold_cache.fold
 import RNA
 
+# ASCII code -> index into the composition counts [A, C, G, U, other]
+NUCLEOTIDE_INDEX = bytes([{65: 0, 67: 1, 71: 2, 85: 3}.get(code, 4) for code in range(256)])
+
+# Compact record of an evaluated design, returned by the environments at the end of an episode
+EpisodeResult = namedtuple('EpisodeResult', [
+    'sequence', 'folded_structure', 'hd', 'fe', 'reward', 'time', 'file_nr', 'source',
+    'permutation_folds', 'duplicates_avoided'])
+
+def statistic(name, description):
+    """
+    Statistic of the solution that is computed on first access and memoized
+    """
+    def getter(self):
+        if name not in self.statistics:
+            self.compute_statistic(name)
+        return self.statistics[name]
+
+    def setter(self, value):
+        self.statistics[name] = value
+
+    return property(getter, setter, doc=description)
+
 class Solution(object):
     """
     Class for logging generated nucleotide sequence solutions
+
+    The nucleotides are stored as ASCII codes in a bytearray
+    and the nucleotide composition is updated on every insertion
     """
+    __slots__ = [
+        'config', 'target', 'time', 'start', 'source', 'sequence', 'counts',
+        'hd', 'fe', 'r', 'permutation_folds', 'duplicates_avoided',
+        'mismatch_indices', 'folded_structure', 'reward_exp', 'kernel_size',
+        'index', 'step', 'rows', 'encoding',
+        'statistics', 'context', 'parameters']
+
+    mapping        = {0:'AU', 1:'CG', 2:'GC', 3:'UA', 4:'GU', 5:'UG'}
+    reverse_action = {0:3, 1:2, 2:1, 3:0, 4:5, 5:4}
+    codes          = {action: (ord(pair[0]), ord(pair[1])) for action, pair in mapping.items()}
+    # Candidate nucleotides of boost() per interior loop, in the order of the plan positions
+    boosting_pairs = {
+        (1, 1): [b'UU', b'GA', b'AG'],
+        (2, 1): [b'UCU', b'GAA'],
+        (2, 2): [b'GUGU', b'UGUG'],
+        (3, 3): [b'GAGA', b'AGAG']}
+
+    # Statistics, computed on first access
+    md                 = statistic('md', 'Mountain distance to the target')
+    bpd                = statistic('bpd', 'Base pair distance to the target')
+    partition_prob     = statistic('partition_prob', 'Partition function structure (pair probabilities)')
+    partition_fn       = statistic('partition_fn', 'Ensemble free energy')
+    positional_entropy = statistic('positional_entropy', 'Positional entropy of the ensemble')
+    centroid_structure = statistic('centroid_structure', 'Centroid structure of the ensemble')
+    centroid_dist      = statistic('centroid_dist', 'Distance of the centroid to the ensemble')
+    centroid_en        = statistic('centroid_en', 'Free energy of the centroid structure')
+    MEA_structure      = statistic('MEA_structure', 'Maximum expected accuracy structure')
+    MEA                = statistic('MEA', 'Expected accuracy of the MEA structure')
+    MEA_en             = statistic('MEA_en', 'Free energy of the MEA structure')
+    probability        = statistic('probability', 'Probability of the MFE structure in the ensemble')
+    ensemble_diversity = statistic('ensemble_diversity', 'Mean base pair distance of the ensemble')
+    ensemble_defect    = statistic('ensemble_defect', 'Ensemble defect of the MFE structure')
+
     def __init__(self, target, config=None, string=None, time=None, source='rlif'):
         self.config = config
+        self.parameters = get_parameter_set(config.get('parameters')) # None = global Vienna parameters
         self.target = target
         self.time   = time
         self.start  = None
-        self.mapping        = {0:'AU', 1:'CG', 2:'GC', 3:'UA', 4:'GU', 5:'UG'}
-        self.reverse_action = {0:3, 1:2, 2:1, 3:0, 4:5, 5:4}
         self.source = source
-        self.str = ['-'] * target.len # List of chars ['-', 'A', "C", "G", "U"]
+        self.sequence = bytearray(b'-' * target.len) # ASCII codes of ['-', 'A', "C", "G", "U"]
+        self.counts = [0, 0, 0, 0, target.len]       # A, C, G, U, unfilled
 
         # Statistics
         self.hd = 100 # Hamming distance
-        self.md = 0   # Mountain
         self.fe = 0   # Gibbs free energy
         self.r  = 0   # Reward
+        self.permutation_folds  = 0 # Distinct folds made by the permutation search
+        self.duplicates_avoided = 0 # Mutants skipped because they were already evaluated
 
         self.mismatch_indices = None
         self.folded_structure = ''
         self.reward_exp  = config['reward_exp']
         self.kernel_size = config['kernel_size']
-        self.index = 0
+        self.step  = 0 # Position in the fill schedule of the target
+        self.index = target.schedule_list[0]
         self.create_encoding()
-        if self.config_check('boosting'):
-            self.graph, = forgi.load_rna(self.target.seq)
 
         self.init_vars()
         if string is not None:
-            self.str = [x for x in string]
+            self.str = string
             self.evaluate(string, permute=False, compute_statistics=True)
 
         if time is None:
             self.start = t.time()
 
 
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+        state['context'] = None # Holds the fold compound, which is not picklable
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def result(self):
+        """
+        EpisodeResult of the evaluated solution (a few hundred bytes pickled)
+        """
+        return EpisodeResult(
+            self.string, self.folded_structure, self.hd, self.fe, self.r, self.time, self.target.file_nr, self.source,
+            self.permutation_folds, self.duplicates_avoided)
+
+    @classmethod
+    def from_result(cls, result, target, config):
+        """
+        Solution of the target rebuilt from an EpisodeResult without folding it again,
+        the statistics are computed on first access
+        """
+        solution = cls(target=target, config=config, time=result.time, source=result.source)
+        solution.str = result.sequence
+        solution.folded_structure, solution.fe = result.folded_structure, result.fe
+        solution.hd, solution.mismatch_indices = hamming_distance(target.seq_array, result.folded_structure)
+        solution.r = result.reward
+        solution.permutation_folds = result.permutation_folds
+        solution.duplicates_avoided = result.duplicates_avoided
+        return solution
+
     def config_check(self, parameter):
         """
         Checks whether the config is present in the .yml config file of the model
@@ -63,23 +156,46 @@ class Solution(object):
         """
         Generate the representations of the nucleotide sequence of required length based on the the target structure
         """
-        k = self.kernel_size
-        self.rows, length = self.target.structure_encoding.shape
-        structure_encoding = np.zeros([self.rows, length + k * 2]) # Padding
-        structure_encoding[:,k:-k] = self.target.structure_encoding
-
-        if self.config_check('use_nucleotides'):
-            nucleotide_encoding = np.zeros([4, length + k * 2])
-            self.encoding = np.vstack([structure_encoding, nucleotide_encoding])
-        else:
-            self.encoding = structure_encoding
+        self.rows = self.target.structure_encoding.shape[0]
+        template = self.target.padded_encoding(self.kernel_size, self.config_check('use_nucleotides'))
+        self.encoding = template.copy()
         
     @property
     def string(self):
         """
         Returns the nucleotide sequence of the solution in string format
         """
-        return ''.join(self.str)
+        return self.sequence.decode()
+
+    @property
+    def str(self):
+        """
+        The nucleotide sequence as a list of chars
+        """
+        return list(self.string)
+
+    @str.setter
+    def str(self, nucleotides):
+        self.sequence = bytearray(''.join(nucleotides).encode())
+        self.recount()
+        self.init_vars()
+
+    def recount(self):
+        """
+        Recompute the nucleotide composition after bulk changes of the sequence
+        """
+        sequence = self.sequence
+        acgu = [sequence.count(code) for code in b'ACGU']
+        self.counts = acgu + [len(sequence) - sum(acgu)]
+
+    def set_nucleotide(self, index, code):
+        """
+        Set the nucleotide (ASCII code) at index, keeping the composition counts up to date
+        """
+        counts = self.counts
+        counts[NUCLEOTIDE_INDEX[self.sequence[index]]] -= 1
+        counts[NUCLEOTIDE_INDEX[code]] += 1
+        self.sequence[index] = code
     
     def insert_nucleotide(self, action):
         """
@@ -90,55 +206,60 @@ class Solution(object):
         
         # Unpaired nucleotide
         self.encoding[self.rows + action, i + k] = 1
-        self.str[i] = self.mapping[action][0]
-
-        # Base pair
-        if self.target.seq[i] == '(':
-            try:
-                pair_index = self.target.base_pair_indices[i]
-                nucleotide = self.reverse_action[action]
-                self.encoding[self.rows + nucleotide, pair_index + k] = 1
-                self.str[pair_index] = self.mapping[action][1]
-            except:
-                pass
+        self.set_nucleotide(i, self.codes[action][0])
+
+        # Base pair (opening bracket)
+        pair_index = self.target.pair_list[i]
+        if pair_index > i:
+            nucleotide = self.reverse_action[action]
+            self.encoding[self.rows + nucleotide, pair_index + k] = 1
+            self.set_nucleotide(pair_index, self.codes[action][1])
+
+    @property
+    def filled(self):
+        """
+        True once the last position of the fill schedule has been reached
+        """
+        return self.step >= self.target.episode_length - 1
 
     def find_next_unfilled(self):
         """
-        Set current index to the next unfilled nucleotide
+        Set current index to the next unfilled nucleotide in the fill schedule of the target
         """
-        index = self.index
-        while index < self.target.len - 1:
-            if self.str[index] == '-':
-                break
-            index += 1
-        self.index = index
+        if not self.filled:
+            self.step += 1
+            self.index = self.target.schedule_list[self.step]
         
     def get_state(self, reshape=False):
         """
         Return the current state of the solution (window around the current nucleotide)
+        The CNN state is a view into the encoding, the flattened MLP state is a copy
         """
         i = self.index 
         k = self.kernel_size
         state = self.encoding[:, i:i+2*k]
-        return state.flatten() if reshape else np.expand_dims(state, axis=2)
+        return state.flatten() if reshape else state[:, :, np.newaxis]
     
-    def evaluate(self, string=None, permute=False, compute_statistics=False, boost=False, reward=False, verbose=False):
+    def evaluate(self, string=None, permute=False, compute_statistics=False, boost=False, reward=False, verbose=False, folded=None):
         """
         Evaluate the current solution, measure the hamming distance between the folded structure and the target
+        folded: (structure, free energy) of the sequence if it was already folded elsewhere
         """
         if boost and string is None:
             self.boost()
 
         if string is None: string = self.string
 
-        self.folded_structure, self.fe = fold_fn(string)
-        self.hd, self.mismatch_indices = hamming_distance(self.target.seq, self.folded_structure)
+        self.init_vars()
+        self.folded_structure, self.fe = fold_fn(string, self.parameters) if folded is None else folded
+        self.hd, self.mismatch_indices = hamming_distance(self.target.seq_array, self.folded_structure)
 
         # Permutations
         if permute and 0 < self.hd <= self.config['permutation_threshold']:
-            self.str, self.hd = self.permute(self.mismatch_indices, verbose=verbose)
-            self.folded_structure, self.fe = fold_fn(self.string)
-            self.hd, self.mismatch_indices = hamming_distance(self.target.seq, self.folded_structure)
+            self.sequence, self.hd = self.permute(self.mismatch_indices, verbose=verbose)
+            self.recount()
+            self.folded_structure, self.fe = fold_fn(self.string, self.parameters)
+            self.hd, self.mismatch_indices = hamming_distance(self.target.seq_array, self.folded_structure)
 
         if compute_statistics: self.compute_statistics()
 
@@ -158,57 +279,27 @@ class Solution(object):
         """
         Performs a local improvement on the mismatch sites 
         """
-        budget = self.config['permutation_budget']
-        radius = self.config['permutation_radius']
-        window = range(1, radius+1)
+        if self.config.get('permutation_population', 1) > 1:
+            return self.permute_population(original_mismatch_indices, verbose=verbose)
 
-        # Get indices of nucleotides around the mismatches within a radius
-        def get_surrounding(mismatches): 
-            all_indices = []
-            probs = {}
-            probabilities = list(np.linspace(0.01, self.config['mutation_probability'], radius+1))[:-1]
-            for index in mismatches:
-                for i in window:
-                    probs[index] = self.config['mutation_probability']
-                    # Nucleotides at i+1 and i-1
-                    if index - i >= 0:
-                        all_indices.append(index-i)
-                        probs[index-i] = probabilities[i-1]
-                    if index + i <= self.target.len -1:
-                        all_indices.append(index+i)
-                        probs[index+i] = probabilities[-i]
-            mismatches = list(mismatches) + all_indices
-            return set(all_indices), probs
-
-        best_permutation, permutation = copy.deepcopy(self.str), copy.deepcopy(self.str)
+        budget = self.config['permutation_budget']
+        visited = self.tabu_memo()
+        best_permutation = bytearray(self.sequence)
         hd, min_hd = self.hd, self.hd
-        best_mismatch_indices, probs = get_surrounding(original_mismatch_indices)
+        best_mismatch_indices, probs = self.get_surrounding(original_mismatch_indices)
         step = 0
         while hd != 0 and step < budget:
-            for mismatch in best_mismatch_indices:
-                if random.random() < probs[mismatch]:
-                    action = random.randint(0,3)
-                    if self.config['allow_gu_permutations'] and self.target.seq[mismatch] != '.':
-                        action = random.randint(0, 5)
-
-                    # In case of a stem/helix find the paired nucleotide
-                    permutation[mismatch] = self.mapping[action][0]
-                    if self.target.seq[mismatch] != '.':
-                        if self.target.base_pair_indices.get(mismatch) is not None:
-                            pair = self.target.base_pair_indices.get(mismatch)
-                        if self.target.rev_base_pair_indices.get(mismatch) is not None:
-                            pair = self.target.rev_base_pair_indices.get(mismatch)
-                        permutation[pair] = self.mapping[action][1]
-
-            string = ''.join(permutation)
-            folded, _ = fold_fn(string)
-            hd, mismatch_indices = hamming_distance(self.target.seq, folded)
+            permutation, string = self.sample_mutant(best_permutation, best_mismatch_indices, probs, visited)
+            if permutation is None:
+                break # No unvisited mutants left around the mismatches
+
+            folded, _ = fold_fn(string, self.parameters)
+            self.permutation_folds += 1
+            hd, mismatch_indices = hamming_distance(self.target.seq_array, folded)
             if hd < min_hd: 
                 min_hd = hd
-                best_permutation = copy.deepcopy(permutation)
-                best_mismatch_indices, probs = get_surrounding(mismatch_indices)
-            else:
-                permutation = copy.deepcopy(best_permutation)
+                best_permutation = permutation
+                best_mismatch_indices, probs = self.get_surrounding(mismatch_indices)
             step += 1
 
             if hd == 0:
@@ -218,101 +309,229 @@ class Solution(object):
 
         return best_permutation, min_hd
 
+    def permute_population(self, original_mismatch_indices, verbose=False):
+        """
+        Population based local search on the mismatch sites
+
+        Every step samples permutation_population mutants around the mismatches of the
+        current best sequence(s) and folds them in parallel. The 'elitist' strategy keeps
+        the single best sequence, 'beam' keeps the permutation_beam best ones.
+        The permutation budget is counted in folds.
+        """
+        budget = self.config['permutation_budget']
+        population = self.config['permutation_population']
+        width = 1
+        if self.config.get('permutation_strategy') == 'beam':
+            width = max(1, self.config.get('permutation_beam', 1))
+
+        visited = self.tabu_memo()
+        indices, probs = self.get_surrounding(original_mismatch_indices)
+        beam = [(self.hd, bytearray(self.sequence), indices, probs)]
+        folds = 0
+        while beam[0][0] != 0 and folds < budget:
+            n_mutants = min(population, budget - folds)
+            mutants, strings = [], []
+            for k in range(n_mutants):
+                _, parent, indices, probs = beam[k % len(beam)]
+                mutant, string = self.sample_mutant(parent, indices, probs, visited)
+                if mutant is not None:
+                    mutants.append(mutant)
+                    strings.append(string)
+            if len(mutants) == 0:
+                break # No unvisited mutants left around the mismatches
+
+            folded = fold_many(strings, parameters=self.parameters)
+            folds += len(mutants)
+            self.permutation_folds += len(mutants)
+
+            # Parents come first so that they are kept on ties
+            candidates = list(beam)
+            hds, mismatches = hamming_distances(self.target.seq_array, [structure for structure, _ in folded])
+            for mutant, hd, mismatch in zip(mutants, hds, mismatches):
+                candidates.append((int(hd), mutant) + self.get_surrounding(np.flatnonzero(mismatch)))
+            candidates.sort(key=lambda candidate: candidate[0])
+            beam = candidates[:width]
+
+        min_hd, best_permutation = beam[0][0], beam[0][1]
+        if min_hd == 0:
+            self.source = 'rlif*'
+        return best_permutation, min_hd
+
+    def get_surrounding(self, mismatches):
+        """
+        Get indices of nucleotides around the mismatches within a radius
+        and their mutation probabilities
+        """
+        radius = self.config['permutation_radius']
+        window = range(1, radius+1)
+        all_indices = []
+        probs = {}
+        probabilities = list(np.linspace(0.01, self.config['mutation_probability'], radius+1))[:-1]
+        for index in mismatches:
+            for i in window:
+                probs[index] = self.config['mutation_probability']
+                # Nucleotides at i+1 and i-1
+                if index - i >= 0:
+                    all_indices.append(index-i)
+                    probs[index-i] = probabilities[i-1]
+                if index + i <= self.target.len -1:
+                    all_indices.append(index+i)
+                    probs[index+i] = probabilities[-i]
+        return set(all_indices), probs
+
+    def tabu_memo(self):
+        """
+        Set of sequences that were already evaluated by the permutation search
+        'call': new set per permute() call, 'target': shared by all solutions of the target
+        that fold with the same parameters (the memo is restarted when the parameters change)
+        """
+        mode = self.config_check('permutation_tabu')
+        if mode == 'target':
+            key = vienna_key() if self.parameters is None else self.parameters.key
+            memo = self.target.visited
+            if memo is None or memo[0] != key or len(memo[1]) > settings.FOLD_CACHE_SIZE:
+                memo = self.target.visited = key, set()
+            visited = memo[1]
+        elif mode:
+            visited = set()
+        else:
+            return None
+        visited.add(bytes(self.sequence))
+        return visited
+
+    def sample_mutant(self, parent, indices, probs, visited=None):
+        """
+        Mutate a copy of the parent sequence, resampling mutants that are already in the tabu memo
+        Returns (None, None) if no unvisited mutant was found
+        """
+        resamples = self.config.get('permutation_resamples', 10)
+        for _ in range(resamples):
+            mutant = bytearray(parent)
+            self.mutate(mutant, indices, probs)
+            if visited is None:
+                return mutant, mutant.decode()
+            key = bytes(mutant)
+            if key not in visited:
+                visited.add(key)
+                return mutant, mutant.decode()
+            self.duplicates_avoided += 1
+        return None, None
+
+    def mutate(self, permutation, indices, probs):
+        """
+        Randomly mutate the nucleotides at the given indices (in place)
+        """
+        for mismatch in indices:
+            if random.random() < probs[mismatch]:
+                action = random.randint(0,3)
+                if self.config['allow_gu_permutations'] and self.target.seq[mismatch] != '.':
+                    action = random.randint(0, 5)
+
+                # In case of a stem/helix find the paired nucleotide
+                permutation[mismatch] = self.codes[action][0]
+                if self.target.seq[mismatch] != '.':
+                    if self.target.base_pair_indices.get(mismatch) is not None:
+                        pair = self.target.base_pair_indices.get(mismatch)
+                    if self.target.rev_base_pair_indices.get(mismatch) is not None:
+                        pair = self.target.rev_base_pair_indices.get(mismatch)
+                    permutation[pair] = self.codes[action][1]
+
     def compute_statistics(self):
         """
-        Compute various statistics about the secondary RNA structure
-        """
-        model_details = RNA.md()
-        fc = RNA.fold_compound(self.string, model_details)
-        fold, fe = fc.mfe()
-        fc.exp_params_rescale(self.fe)
-        self.partition_prob, self.partition_fn = fc.pf()
-        self.positional_entropy = fc.positional_entropy()
-        self.centroid_structure, self.centroid_dist = fc.centroid()
-        self.centroid_en = fc.eval_structure(self.centroid_structure)
-        self.MEA_structure, self.MEA = fc.MEA()
-        self.MEA_en = fc.eval_structure(self.MEA_structure)
-        self.probability = fc.pr_structure(fold)
-        self.ensemble_diversity = fc.mean_bp_distance()
-        self.ensemble_defect = fc.ensemble_defect(fold)
-        self.md = RNA.dist_mountain(self.target.seq, fold)
+        Discard the statistics of the previous sequence
+        The statistics are computed on first access (see the statistic properties)
+        """
+        self.init_vars()
 
     def init_vars(self):
-        self.probability = None
-        self.positional_entropy = None
-        # Partition function
-        self.partition_prob = None
-        self.partition_fn = None
-        # Centroid
-        self.centroid_structure = None
-        self.centroid_dist = None
-        self.centroid_en = None
-        # MEA
-        self.MEA_structure = None
-        self.MEA = None
-        self.MEA_en = None
-        self.ensemble_diversity = None
-        self.ensemble_defect = None
+        self.statistics = {} # Memoized statistics of the current sequence
+        self.release()
+
+    def get_context(self):
+        """
+        Evaluation context of the current sequence, created once and shared by all of
+        the ensemble statistics. Reuses the MFE result of evaluate()
+        """
+        if self.context is None:
+            structure, energy = self.mfe()
+            self.context = EvaluationContext(self.string, structure, energy, parameters=self.parameters)
+        return self.context
+
+    def release(self):
+        """
+        Free the fold compound of the evaluation context, the computed statistics are kept
+        """
+        if getattr(self, 'context', None) is not None:
+            self.context.release()
+        self.context = None
+
+    def mfe(self):
+        """
+        The MFE structure and free energy, reusing the result of evaluate()
+        """
+        if self.folded_structure:
+            return self.folded_structure, self.fe
+        return fold_fn(self.string, self.parameters)
+
+    def compute_statistic(self, name):
+        """
+        Compute a statistic (and the ones that come with it) of the current sequence
+        """
+        statistics = self.statistics
+        if name == 'md':
+            statistics[name] = RNA.dist_mountain(self.target.seq, self.mfe()[0])
+            return
+        if name == 'bpd':
+            statistics[name] = RNA.bp_distance(self.target.seq, self.mfe()[0])
+            return
+
+        context = self.get_context()
+        if name in ['partition_prob', 'partition_fn']:
+            statistics['partition_prob'], statistics['partition_fn'] = context.pf()
+        elif name in ['centroid_structure', 'centroid_dist', 'centroid_en']:
+            structure, distance = context.centroid()
+            statistics.update(centroid_structure=structure, centroid_dist=distance, centroid_en=context.eval_structure(structure))
+        elif name in ['MEA_structure', 'MEA', 'MEA_en']:
+            structure, mea = context.MEA()
+            statistics.update(MEA_structure=structure, MEA=mea, MEA_en=context.eval_structure(structure))
+        else:
+            # positional_entropy, probability, ensemble_diversity, ensemble_defect
+            statistics[name] = getattr(context, name)()
 
     def gcau_content(self):
         """
         Get the proportions of each nucleotide in the generated solution
         """
-        gcau = dict(G=0, C=0, A=0, U=0)
-        increment = 1. / len(self.str)
-        for nucleotide in self.str:
-            try:
-                gcau[nucleotide] += increment
-            except:
-                pass
-        return gcau
+        length = float(len(self.sequence))
+        a, c, g, u, _ = self.counts
+        return dict(G=g/length, C=c/length, A=a/length, U=u/length)
 
     def boost(self, full=False):
+        """
+        Rewrite loop nucleotides with stabilizing mismatches, following the
+        boosting plan of the target (the forgi graph is only walked once per target)
+        """
+        sequence = bytearray(self.sequence)
+        interior, hairpins = self.target.boosting_plan
+
         # Internal
-        
-        for i in self.graph.iloop_iterator():
-            dims = self.graph.get_node_dimensions(i)
-            indices = self.graph.elements_to_nucleotides([i])
-            strand1 = indices[:dims[0]]
-            strand2 = indices[-dims[1]:]
-
-            if dims[1] > dims[0]:
-                strand1, strand2 = strand2, strand1
-            dims = (max(dims), min(dims))
-
-            if dims == (1, 1):
-                pair = random.sample([('U', 'U'), ('G', 'A'), ('A', 'G')], 1)[0]
-                if random.random() > 0.5:
-                    self.str[strand1[0]-1], self.str[strand2[-1]-1] = pair
-                    
-            if dims == (2, 1):
-                pair = random.sample([['U', 'C', 'U'], ['G', 'A', 'A']], 1)[0]
-                if random.random() > 0.5:
-                    self.str[strand1[0]-1], self.str[strand1[1]-1] = pair[:2] # G, C / G, A
-                    self.str[strand2[0]-1] = pair[2] # A / G
-
-            if full and dims == (2, 2):
-                pair = random.sample([('G', 'U'), ('U', 'G')], 1)[0]
-                if random.random() > 0.5:
-                    self.str[strand1[0]-1], self.str[strand1[1]-1] = pair
-                    self.str[strand2[0]-1], self.str[strand2[1]-1] = pair
-
-            if (dims[0] > 2 and dims[1] > 2) and (dims[0] >= 3 or dims[1] >= 3):
-                pair = random.sample([['G', 'A'],['A', 'G']], 1)[0]
-                if random.random() > 0.5:
-                    self.str[strand1[0]-1], self.str[strand1[1]-1] = pair
-                    self.str[strand2[1]-1], self.str[strand2[0]-1] = pair
-    
+        for dims, positions in interior:
+            if dims == (2, 2) and not full:
+                continue
+            pair = random.sample(self.boosting_pairs[dims], 1)[0]
+            if random.random() > 0.5:
+                for position, code in zip(positions, pair):
+                    sequence[position] = code
+
         # Hairpins
-        for h in self.graph.hloop_iterator():
-            indices = self.graph.elements_to_nucleotides([h])
-            if random.random() > 0.5 and len(indices) > 3:
-                # pair = random.sample([('U', 'U'), ('G', 'A')], 1)[0]
-                pair = ['G', 'A']
-                dims = self.graph.get_node_dimensions(h)
-                strand1 = indices[:dims[0]]
-                self.str[strand1[0]-1], self.str[strand1[-1]-1] = pair
-            
+        for positions in hairpins:
+            if random.random() > 0.5 and positions is not None:
+                sequence[positions[0]], sequence[positions[1]] = b'GA'
+
+        self.sequence = sequence
+        self.recount()
+        self.init_vars()
+
         # # Close stems with GC/CG
         # for s in self.graph.stem_iterator():
         #     nucls = [('G', 'C'), ('C', 'G')] #('G', 'U'), ('U', 'G'), 
@@ -333,8 +552,9 @@ class Solution(object):
         gcau = self.gcau_content()
         date = datetime.datetime.now().strftime("%m-%d_%H-%M")
         separator = '\n\n' + ''.join(["*"] * 20) + ' ' + date + ' ' + ''.join(["*"] * 20)
+        file_nr = '-' if self.target.file_nr is None else self.target.file_nr
         header = '\n\nSeq Nr. {:5}, Len: {:3}, DBr: {:.2f}, HD: {:3}, Reward: {:.5f}'.format(
-                  self.target.file_nr, self.target.len, self.target.percent_unpaired, self.hd, self.r)
+                  file_nr, self.target.len, self.target.percent_unpaired, self.hd, self.r)
         header += '  ||   G:{:.2f} | C:{:.2f} | A:{:.2f} | U:{:.2f} |'.format(gcau['G'], gcau['C'], gcau['A'], gcau['U'])
         solution = 'S:  ' + self.string
         folded   = 'F:  ' + self.folded_structure
@@ -362,21 +582,22 @@ class Solution(object):
         print("MEA %s {%6.2f MEA=%.2f}" % (self.MEA_structure, self.MEA_en, self.MEA))
         print(" frequency of mfe structure in ensemble %g; ensemble diversity %-6.2f" % (self.probability), self.ensemble_diversity)
 
-    def write_solution(self):
+    def write_solution(self, writer=None):
         """
         Writes a solution to the results.log file in the model folder
+        or to an open SolutionWriter (for writing many solutions)
         """
+        if writer is not None:
+            writer.write(self)
+            return
         date = datetime.datetime.now().strftime("%m-%d_%H-%M")
         if 'path' in self.config.keys():
             path = os.path.join(self.config['path'], 'results.log')
         else:
-            date = datetime.datetime.strftime
             path = os.path.join(settings.RESULTS, 'results__{}.log'.format(date))
 
-        lines = self.summary()
-        with open(os.path.join(path), 'a+') as f:
-            for line in lines:
-                f.write(line + '\n')
+        with SolutionWriter(path, file_format='log', mode='a') as writer:
+            writer.write(self)
 
     def visualize(self, auto=False):
         """
@@ -3,39 +3,60 @@ from rlif.settings import ConfigManager as settings
 import os, random
 import copy, datetime, yaml
 import rlif
-import sys, subprocess, time
+import sys, subprocess, time, itertools, gzip, csv, json
 from .dotbracket import DotBracket
 
-def load_fasta(filename, config=None):
+def read_fasta(filename):
     """
-    Returns a list of Solution Objects obtained by reading a fasta file
+    Yields the (name, sequence) records of a fasta file as they are read
     """
-    from .solution import Solution
-    fname = filename.split(settings.delimiter)[-1]
+    name, lines = '', []
     with open(filename, 'r') as fasta:
-        seq = ''
-        sequences = []
-        for line in fasta.readlines():
+        for line in fasta:
             if line[0] == '>':
-                name = line[1:].strip('\n')
-                if seq != '':
-                    seq = seq.replace('T', 'U')
-                    structure, fe = settings.fold_fn(seq)
-                    target = DotBracket(structure)
-                    target.name = name
-                    target.nucleotides = seq
-                    solution = Solution(target=target, config=config, string=seq, time=0, source=fname)
-                    sequences.append(solution)
-                    seq = ''
+                if len(lines) > 0:
+                    yield name, ''.join(lines).replace('T', 'U')
+                name, lines = line[1:].strip('\n'), []
             else:
-                seq += line.strip('\n')
+                lines.append(line.strip('\n'))
+    if len(lines) > 0:
+        yield name, ''.join(lines).replace('T', 'U')
 
-    return sequences
+def iter_fasta(filename, config=None, workers=None, chunk_size=64, max_in_flight=None):
+    """
+    Yields Solution objects of the records of a fasta file in file order
+    The records are folded in the background by the fold engine with a bounded
+    number of chunks in flight (see fold_stream)
+    """
+    from .solution import Solution
+    from .vienna import fold_stream, get_parameter_set
+    fname = filename.split(settings.delimiter)[-1]
+    parameters = get_parameter_set(config.get('parameters')) if config is not None else None
+
+    records, to_fold = itertools.tee(read_fasta(filename))
+    folded = fold_stream(
+        (seq for _, seq in to_fold),
+        workers=workers,
+        chunk_size=chunk_size,
+        max_in_flight=max_in_flight,
+        parameters=parameters)
+    for (name, seq), (structure, fe) in zip(records, folded):
+        target = DotBracket(structure)
+        target.name = name
+        target.nucleotides = seq
+        yield Solution(target=target, config=config, string=seq, time=0, source=fname)
+
+def load_fasta(filename, config=None, workers=None):
+    """
+    Returns a list of Solution Objects obtained by reading a fasta file
+    The sequences are folded in parallel (see iter_fasta)
+    """
+    return list(iter_fasta(filename, config=config, workers=workers))
 
 
 def write_fasta(filename, sequences, write_dot_brackets=False, linebreak=80):
     """
-    Write a fasta file from a list of Solution Objects
+    Append a list of Solution Objects to a fasta file
     >Name
     AUGUACGA
     ...
@@ -47,32 +68,163 @@ def write_fasta(filename, sequences, write_dot_brackets=False, linebreak=80):
     ((....))
     ...
     """
-    with open(filename, 'a+') as fasta:
-        if fasta.readlines().count() > 1:
-            fasta.write('\n')
+    file_format = 'vienna' if write_dot_brackets else 'fasta'
+    with SolutionWriter(filename, file_format=file_format, mode='a', linebreak=linebreak) as writer:
+        writer.write_many(sequences)
+    return writer.count
+
+
+class SolutionWriter(object):
+    """
+    Streaming exporter of solutions through a single buffered file handle
+
+    Formats (inferred from the extension if not given, .gz compresses):
+        fasta   >name, nucleotide sequence
+        vienna  >name, nucleotide sequence, target dot-bracket
+        csv     one row of fields and statistics per solution
+        jsonl   one JSON object of fields and statistics per line
+        log     Solution.summary() lines (results.log)
+
+    Solutions are formatted chunk_size at a time, so an iterable of any size can be
+    written without holding it in memory. Statistics (e.g. 'md', 'probability',
+    'ensemble_defect') are computed on demand and the solution's fold compound
+    is released afterwards.
+
+    with SolutionWriter('solutions.jsonl.gz', statistics=['probability']) as writer:
+        writer.write_many(solutions)
+    """
+    formats = dict(fasta='fasta', fa='fasta', vienna='vienna', dbn='vienna', csv='csv', jsonl='jsonl', log='log')
+    fields = ['name', 'sequence', 'target', 'folded', 'hd', 'fe', 'reward', 'length', 'time', 'source']
+
+    def __init__(self, filename, file_format=None, mode='w', compress=None, linebreak=80, statistics=(), chunk_size=256):
+        extensions = os.path.basename(filename).lower().split('.')
+        if compress is None:
+            compress = extensions[-1] == 'gz'
+        if file_format is None:
+            extension = extensions[-2] if extensions[-1] == 'gz' and len(extensions) > 2 else extensions[-1]
+            file_format = self.formats.get(extension, 'fasta')
+        if file_format not in self.formats.values():
+            raise ValueError('Unknown solution file format: {}'.format(file_format))
+
+        self.filename = filename
+        self.file_format = file_format
+        self.linebreak = linebreak
+        self.statistics = list(statistics)
+        self.chunk_size = chunk_size
+        self.count = 0
+
+        new_file = mode == 'w' or not os.path.isfile(filename) or os.path.getsize(filename) == 0
+        if compress:
+            self.handle = gzip.open(filename, mode + 't', newline='')
+        else:
+            self.handle = open(filename, mode, newline='', buffering=1 << 20)
+        if file_format == 'csv':
+            self.csv = csv.writer(self.handle, lineterminator='\n')
+            if new_file:
+                self.csv.writerow(self.fields + self.statistics)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def wrap(self, string):
+        if not self.linebreak:
+            return string + '\n'
+        return ''.join([string[i:i+self.linebreak] + '\n' for i in range(0, len(string), self.linebreak)])
 
-        for solution in sequences:
-            name = '>' + sequence.target.name + '\n'
-            linebreaks = np.arange([0, len(solution.string), linebreak])
-            nucleotide_string = [solution.string[i:i+linebreak]+'\n' for i in linebreaks]
-            fasta.write(name)
-            fasta.write(nucleotide_string)
-            if write_dot_brackets:
-                dotbrackets = [solution.target.seq[i:i+linebreak]+'\n' for i in linebreaks]
-                fasta.write(dotbrackets)
-            fasta.write('\n')
+    def record(self, solution):
+        """
+        Fields and requested statistics of a solution
+        """
+        target = solution.target
+        name = target.name or 'seq{}_{}'.format(target.file_nr, self.count + 1)
+        row = [name, solution.string, target.seq, solution.folded_structure, solution.hd,
+               solution.fe, solution.r, target.len, solution.time, solution.source]
+        # The fold compound is only freed if it was created for the statistics
+        created = self.statistics and getattr(solution, 'context', None) is None
+        row += [getattr(solution, statistic) for statistic in self.statistics]
+        if created:
+            solution.release()
+        return row
 
+    def format(self, solution):
+        row = self.record(solution)
+        self.count += 1
+        if self.file_format == 'fasta':
+            return '>{}\n'.format(row[0]) + self.wrap(row[1])
+        if self.file_format == 'vienna':
+            return '>{}\n'.format(row[0]) + self.wrap(row[1]) + self.wrap(row[2])
+        if self.file_format == 'jsonl':
+            return json.dumps(dict(zip(self.fields + self.statistics, row)), default=float) + '\n'
+        if self.file_format == 'log':
+            return ''.join([line + '\n' for line in solution.summary(colorize=False)])
+        return row
 
+    def write(self, solution):
+        self.write_chunk([self.format(solution)])
+
+    def write_chunk(self, records):
+        if self.file_format == 'csv':
+            self.csv.writerows(records)
+        else:
+            self.handle.write(''.join(records))
+
+    def write_many(self, solutions):
+        """
+        Write an iterable of solutions (e.g. a generator) chunk by chunk
+        """
+        chunk = []
+        for solution in solutions:
+            chunk.append(self.format(solution))
+            if len(chunk) >= self.chunk_size:
+                self.write_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.write_chunk(chunk)
+        return self.count
+
+    def close(self):
+        if not self.handle.closed:
+            self.handle.close()
+
+
+def to_uint8(sequence):
+    """
+    Dot-bracket/nucleotide string (or bytes) as a uint8 array of ASCII codes
+    Arrays have to be uint8 already, other dtypes would not compare with the codes
+    """
+    if isinstance(sequence, np.ndarray):
+        if sequence.dtype != np.uint8:
+            raise TypeError('Expected a uint8 array of ASCII codes, got {}.'.format(sequence.dtype))
+        return sequence
+    if isinstance(sequence, str):
+        sequence = sequence.encode()
+    return np.frombuffer(sequence, dtype=np.uint8)
 
 def hamming_distance(seq1, seq2):
     """
     Hamming distance between two strings
     Returns hamming distance and mismatch indices
     """
-    matches = [char1 != char2 for char1, char2 in zip(seq1, seq2)]
-    hd = sum(matches)
-    indices = np.where(matches)[0]
-    return hd, indices
+    seq1, seq2 = to_uint8(seq1), to_uint8(seq2)
+    length = min(len(seq1), len(seq2))
+    indices = np.flatnonzero(seq1[:length] != seq2[:length])
+    return len(indices), indices
+
+def hamming_distances(target, structures):
+    """
+    Hamming distances of many structures of the same length as the target
+    structures: list of strings or a [n, length] uint8 matrix
+    Returns an array of hamming distances and a boolean [n, length] mismatch matrix
+    """
+    target = to_uint8(target)
+    if not isinstance(structures, np.ndarray):
+        structures = np.frombuffer(''.join(structures).encode(), dtype=np.uint8)
+    structures = to_uint8(structures)
+    mismatches = structures.reshape(-1, len(target)) != target
+    return mismatches.sum(axis=1), mismatches
 
 def colorize_nucleotides(sequence):
     """
@@ -128,17 +280,66 @@ def load_sequence(num, dataset='rfam_learn', encoding_type=0):
         print('File {} does not exist...'.format(filename))
         return []
     
-def load_length_metadata(dataset, length):
+length_indices = {}
+
+def length_index_path(dataset):
+    return os.path.join(settings.DATA, 'metadata', dataset, 'lengths.npy')
+
+def write_length_index(dataset, lengths):
     """
-    Loads length metadata
+    Write the length index of a dataset from a {length: [file numbers]} dict:
+    (length, file number) rows sorted by length, file numbers of
+    the same length keep their order
     """
-    filename = os.path.join(settings.DATA, 'metadata', dataset, 'len', '{}.yml'.format(length))
-    try:
-        with open(filename, 'r') as f:
-            data = yaml.load(f)
-        return data
-    except:
-        return []
+    rows = [[length, num] for length in sorted(lengths) for num in lengths[length]]
+    index = np.array(rows, dtype=np.int32).reshape(-1, 2)
+    filename = length_index_path(dataset)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    np.save(filename, index)
+    length_indices.pop(dataset, None)
+    return index
+
+def load_length_index(dataset):
+    """
+    Sorted lengths and the corresponding file numbers of a dataset
+    Built from the per-length YAML metadata the first time if there is no index yet
+    """
+    if dataset not in length_indices:
+        filename = length_index_path(dataset)
+        if not os.path.isfile(filename):
+            directory = os.path.join(settings.DATA, 'metadata', dataset, 'len')
+            if not os.path.isdir(directory):
+                return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+            lengths = {}
+            for name in os.listdir(directory):
+                if name.endswith('.yml'):
+                    with open(os.path.join(directory, name), 'r') as f:
+                        lengths[int(name[:-4])] = yaml.load(f) or []
+            write_length_index(dataset, lengths)
+        index = np.load(filename)
+        length_indices[dataset] = np.ascontiguousarray(index[:, 0]), np.ascontiguousarray(index[:, 1])
+    return length_indices[dataset]
+
+def length_query(lengths, low, high=None, limit=None):
+    """
+    Positions in a sorted array of lengths with low <= length < high
+    (length == low if high is None), at most limit of each length
+    """
+    high = low + 1 if high is None else high
+    if limit is None:
+        start, end = np.searchsorted(lengths, [low, high])
+        return np.arange(start, end)
+    values = np.arange(low, high)
+    starts = np.searchsorted(lengths, values, side='left')
+    ends = np.minimum(np.searchsorted(lengths, values, side='right'), starts + limit)
+    return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] + [np.zeros(0, dtype=np.int64)])
+
+def load_length_metadata(dataset, length, high=None, limit=None):
+    """
+    File numbers of the sequences of a length or of the lengths in [length, high)
+    """
+    lengths, file_nrs = load_length_index(dataset)
+    return file_nrs[length_query(lengths, length, high, limit)].tolist()
 
 
 
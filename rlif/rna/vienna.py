@@ -1,23 +1,50 @@
-import os, subprocess, sys
+import os, subprocess, sys, multiprocessing, threading, itertools
+from collections import OrderedDict, deque
 from rlif.settings import ConfigManager as settings
+from rlif.rna.rnafold import RNAfoldPool
 
 import RNA
 import rlif
 
-def set_vienna_params(params):
+# Energy parameter file currently loaded into RNAlib (None = RNAlib defaults)
+parameter_file = None
+parameter_lock = threading.Lock()
+
+PARAMETER_FILES = {
+    1: 'rna_turner2004.par',
+    2: 'rna_turner1999.par',
+    3: 'rna_andronescu2007.par',
+    4: 'rna_langdon2018.par'}
+
+def parameter_path(param):
     """
-    Set the energy parameters of the RNAfold
+    Path of an energy parameter file given by its number, file name or path
     """
-    param_files = {
-        1: 'rna_turner2004.par',
-        2: 'rna_turner1999.par',
-        3: 'rna_andronescu2007.par',
-        4: 'rna_langdon2018.par'}
+    if param is None:
+        return None
+    if isinstance(param, int):
+        param = PARAMETER_FILES[param]
+    if not os.path.isfile(param) and os.path.isfile(os.path.join(settings.PARAMETERS, param)):
+        param = os.path.join(settings.PARAMETERS, param)
+    return os.path.abspath(param)
 
-    params = os.path.join(settings.MAIN_DIR, 'utils', 'parameters', param_files[param])
-    RNA.read_parameter_file(params)
+def set_vienna_params(param):
+    """
+    Set the energy parameters of the RNAfold
+    """
+    params = parameter_path(param)
+    load_parameter_file(params)
     return params
 
+def load_parameter_file(path):
+    """
+    Load an energy parameter file into RNAlib and keep track of it
+    """
+    global parameter_file
+    with parameter_lock:
+        RNA.read_parameter_file(path)
+        parameter_file = path
+
 def config_vienna(**kwargs):
     """
     Configure RNAfold
@@ -25,24 +52,556 @@ def config_vienna(**kwargs):
     for arg, val in kwargs.items():
         setattr(RNA.cvar, arg, val)
 
-def fold(sequence, worker):
+# RNAlib model settings (RNA.cvar) that can be changed through the config or the interface
+MODEL_DETAILS = ['temperature', 'dangles', 'noGU', 'no_closingGU', 'noLP', 'uniq_ML']
+
+def vienna_key():
     """
-    For Windows 
-    Call RNAfold.exe using subprocess and return 
-    the folded secondary structure sequence and its free energy
+    Identifier of the currently active Vienna parameter set:
+    (parameter file, *the values of MODEL_DETAILS)
+    """
+    cvar = RNA.cvar
+    return (parameter_file,) + tuple([getattr(cvar, name) for name in MODEL_DETAILS])
+
+def model_options(details):
+    """
+    RNAfold command line options of a dict of model details
+    uniq_ML has no option, it does not change the MFE structures
+    """
+    options = ['-T', str(details['temperature']), '-d{}'.format(details['dangles'])]
+    if details.get('noGU'):
+        options += ['--noGU']
+    if details.get('no_closingGU'):
+        options += ['--noClosingGU']
+    if details.get('noLP'):
+        options += ['--noLP']
+    return options
+
+
+class ParameterSet(object):
+    """
+    Energy parameter file and RNAlib model details (temperature, dangles, noGU, ...)
+
+    Folding with a parameter set does not change the global RNAlib state, so several
+    sets can be used in one process. Parameter sets are picklable, the RNAlib
+    parameter objects are rebuilt in every process on first use.
+
+        turner1999 = ParameterSet(2, temperature=25)
+        structure, energy = turner1999.fold(sequence)
+    """
+    def __init__(self, parameter_file=None, temperature=37., dangles=2, noGU=0, **model_details):
+        self.parameter_file = parameter_path(parameter_file)
+        self.model_details = dict(temperature=float(temperature), dangles=dangles, noGU=noGU, **model_details)
+        self.key = (self.parameter_file, tuple(sorted(self.model_details.items())))
+        self.params = None
+
+    def __repr__(self):
+        name = os.path.basename(self.parameter_file) if self.parameter_file else 'default'
+        details = ', '.join(['{}={}'.format(k, v) for k, v in sorted(self.model_details.items())])
+        return 'ParameterSet({}, {})'.format(name, details)
+
+    def __eq__(self, other):
+        return isinstance(other, ParameterSet) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __reduce__(self):
+        # Unpickled sets are shared per process like the ones from get_parameter_set
+        return get_parameter_set, (dict(parameter_file=self.parameter_file, **self.model_details),)
+
+    def load(self):
+        """
+        RNAlib model details and energy parameters of the set
+        """
+        if self.params is None:
+            md = RNA.md()
+            for arg, val in self.model_details.items():
+                setattr(md, arg, val)
+            with self.activate():
+                self.params = md, RNA.param(md)
+        return self.params
+
+    def activate(self):
+        """
+        Context in which the parameter file is loaded into RNAlib (holds the parameter lock)
+        """
+        return ActiveParameters(self.parameter_file)
+
+    def fold_compound(self, sequence):
+        """
+        Fold compound of the sequence using this parameter set
+        """
+        md, params = self.load()
+        fc = RNA.fold_compound(sequence, md)
+        fc.params_subst(params)
+        return fc
+
+    def pf(self, fc, energy):
+        """
+        Partition function of a fold compound of this set, scaled by the MFE
+        RNAlib derives the Boltzmann factors from the loaded parameter file
+        """
+        with self.activate():
+            fc.exp_params_rescale(energy)
+        return fc.pf()
+
+    def fold(self, sequence):
+        """
+        MFE structure and free energy of the sequence
+        """
+        structure, energy = self.fold_compound(sequence).mfe()
+        return structure, energy
+
+    def rnafold_options(self):
+        """
+        Equivalent RNAfold command line options
+        """
+        options = model_options(self.model_details)
+        if self.parameter_file is not None:
+            options += ['-P', self.parameter_file]
+        return options
+
+class ActiveParameters(object):
+    """
+    Temporarily loads a parameter file into RNAlib, the global parameters are
+    restored on exit. Parameter files are read on top of the RNAlib defaults
+    as they may leave sections out.
     """
-    path = os.path.join(settings.RESULTS, 'input{}.rna'.format(worker))
-    write_file(sequence, path)
-    command = 'RNAfold.exe --infile {} --noPS'.format(path)
-    output = subprocess.Popen(command.split(), cwd=settings.VIENNA_DIR, shell=True, stdout=subprocess.PIPE)
-    message = output.communicate()[0].decode("utf-8")
-    message = message.split('\n')[1].split(' ')
-    secondary_structure = message[0]
-    free_energy = message[1].split(')')[0].split('(')[1]
-    try:
-        free_energy = float(free_energy)
-    except:
-        free_energy = 0.
-    
-    return secondary_structure, free_energy
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        parameter_lock.acquire()
+        if self.path is not None:
+            RNA.params_load_RNA_Turner2004()
+            RNA.read_parameter_file(self.path)
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if self.path is not None:
+                if parameter_file is None:
+                    RNA.params_load_RNA_Turner2004()
+                else:
+                    RNA.read_parameter_file(parameter_file)
+        finally:
+            parameter_lock.release()
+
+# One instance per parameter set and process, so the RNAlib parameters are built once
+parameter_sets = {}
+
+def get_parameter_set(spec):
+    """
+    ParameterSet from a config value: None (global RNAlib parameters), a ParameterSet,
+    a parameter file (number, name or path) or a dict of ParameterSet arguments
+    """
+    if spec is None:
+        return None
+    if not isinstance(spec, ParameterSet):
+        spec = ParameterSet(**spec) if isinstance(spec, dict) else ParameterSet(spec)
+    return parameter_sets.setdefault(spec.key, spec)
+
+
+def cache_key(sequence, parameters=None):
+    """
+    Fold cache key of a sequence folded with a parameter set (None = global parameters)
+    """
+    return sequence, vienna_key() if parameters is None else parameters.key
+
+
+class FoldCache(object):
+    """
+    Bounded LRU cache of (structure, free energy) fold results
+    Keyed by the nucleotide sequence and the Vienna parameter set
+    """
+    def __init__(self, size=None):
+        self.size = settings.FOLD_CACHE_SIZE if size is None else size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def fold(self, sequence, parameters=None):
+        """
+        Return the folded structure and free energy of the sequence,
+        only calling fold_fn (or folding with the parameter set) if the result is not cached yet
+        """
+        fold_fn = settings.fold_fn if parameters is None else parameters.fold
+        if self.size <= 0:
+            self.misses += 1
+            return tuple(fold_fn(sequence))
+
+        key = cache_key(sequence, parameters)
+        result = self.get(sequence, key=key)
+        if result is not None:
+            return result
+
+        self.misses += 1
+        result = tuple(fold_fn(sequence))
+        self.put(sequence, result, key=key)
+        return result
+
+    def get(self, sequence, key=None):
+        """
+        Return the cached fold result or None
+        """
+        if key is None:
+            key = cache_key(sequence)
+        result = self._cache.get(key)
+        if result is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+        return result
+
+    def put(self, sequence, result, key=None, miss=False):
+        """
+        Store a fold result computed elsewhere
+        miss: the result was folded because the sequence was not cached (counted in the stats)
+        """
+        if miss:
+            self.misses += 1
+        if self.size <= 0:
+            return
+        if key is None:
+            key = cache_key(sequence)
+        self._cache[key] = tuple(result)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total > 0 else 0.
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hit_rate, size=len(self), max_size=self.size)
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    def clear(self):
+        self._cache.clear()
+        self.reset_stats()
+
+fold_cache = FoldCache()
 
+class EvaluationContext(object):
+    """
+    Owns the RNAlib fold compound (and its DP matrices) of a single sequence
+
+    The MFE, partition function, base pair probabilities, ensemble defect and
+    structure energies are all derived from the same fold compound.
+    A known MFE result (e.g. from the fold cache) is reused instead of refolding.
+    The fold compound is freed by release(), it is recreated if needed again:
+
+        with EvaluationContext(sequence, structure, energy) as context:
+            defect = context.ensemble_defect()
+    """
+    def __init__(self, sequence, structure=None, energy=None, model_details=None, parameters=None):
+        self.sequence = sequence
+        self.model_details = model_details
+        self.parameters = parameters
+        self.structure = structure
+        self.energy = energy
+        self.partition = None
+        self._fold_compound = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @property
+    def fold_compound(self):
+        if self._fold_compound is None:
+            if self.parameters is not None:
+                self._fold_compound = self.parameters.fold_compound(self.sequence)
+            else:
+                model_details = RNA.md() if self.model_details is None else self.model_details
+                self._fold_compound = RNA.fold_compound(self.sequence, model_details)
+            self.partition = None
+        return self._fold_compound
+
+    def mfe(self):
+        """
+        MFE structure and free energy
+        """
+        if self.structure is None:
+            self.structure, self.energy = self.fold_compound.mfe()
+        return self.structure, self.energy
+
+    def pf(self):
+        """
+        Partition function structure and ensemble free energy (computed once)
+        """
+        fc = self.fold_compound
+        if self.partition is None:
+            if self.parameters is not None:
+                self.partition = self.parameters.pf(fc, self.mfe()[1])
+            else:
+                fc.exp_params_rescale(self.mfe()[1])
+                self.partition = fc.pf()
+        return self.partition
+
+    def bpp(self):
+        """
+        Base pair probability matrix
+        """
+        self.pf()
+        return self.fold_compound.bpp()
+
+    def probability(self, structure=None):
+        """
+        Probability of the structure (default: MFE) in the ensemble
+        """
+        self.pf()
+        return self.fold_compound.pr_structure(structure or self.mfe()[0])
+
+    def ensemble_defect(self, structure=None):
+        self.pf()
+        return self.fold_compound.ensemble_defect(structure or self.mfe()[0])
+
+    def ensemble_diversity(self):
+        self.pf()
+        return self.fold_compound.mean_bp_distance()
+
+    def positional_entropy(self):
+        self.pf()
+        return self.fold_compound.positional_entropy()
+
+    def centroid(self):
+        self.pf()
+        return self.fold_compound.centroid()
+
+    def MEA(self):
+        self.pf()
+        return self.fold_compound.MEA()
+
+    def eval_structure(self, structure):
+        """
+        Free energy of the sequence in the given structure
+        """
+        return self.fold_compound.eval_structure(structure)
+
+    def release(self):
+        """
+        Free the fold compound and its DP matrices
+        """
+        self._fold_compound = None
+        self.partition = None
+
+
+def _init_fold_worker(key):
+    """
+    Load the Vienna parameter set once when a fold worker process starts
+    """
+    parameter_file, details = key[0], key[1:]
+    if parameter_file is not None:
+        load_parameter_file(parameter_file)
+    config_vienna(**dict(zip(MODEL_DETAILS, details)))
+
+def _fold_chunk(task):
+    parameters, chunk = task
+    fold_fn = settings.fold_fn if parameters is None else get_parameter_set(parameters).fold
+    return [(i, tuple(fold_fn(sequence))) for i, sequence in chunk]
+
+
+class FoldEngine(object):
+    """
+    Process pool for folding batches of sequences
+    Every worker loads the Vienna parameters that were active when the engine was created
+    """
+    def __init__(self, workers=None):
+        self.workers = settings.WORKERS if workers is None else workers
+        self.key = vienna_key()
+        self.pool = multiprocessing.Pool(
+            self.workers,
+            initializer=_init_fold_worker,
+            initargs=(self.key,))
+
+    def imap(self, indexed_sequences, ordered=True, chunk_size=None, parameters=None):
+        """
+        Fold (index, sequence) pairs, yields (index, (structure, free energy))
+        either in input order or as the chunks finish
+        Folds with the parameter set if given, otherwise with the parameters of the engine
+        """
+        return self.imap_sets([(parameters, list(indexed_sequences))], ordered, chunk_size)
+
+    def imap_sets(self, jobs, ordered=True, chunk_size=None):
+        """
+        Fold [(parameter set, (index, sequence) pairs), ...] in a single pass over the pool
+        """
+        if chunk_size is None:
+            total = sum([len(indexed_sequences) for _, indexed_sequences in jobs])
+            chunk_size = max(1, min(256, total // (self.workers * 4)))
+        tasks = []
+        for parameters, indexed_sequences in jobs:
+            tasks += [(parameters, indexed_sequences[i:i+chunk_size]) for i in range(0, len(indexed_sequences), chunk_size)]
+        mapping = self.pool.imap if ordered else self.pool.imap_unordered
+        for folded in mapping(_fold_chunk, tasks):
+            for result in folded:
+                yield result
+
+    def submit(self, indexed_sequences, parameters=None):
+        """
+        Fold a chunk of (index, sequence) pairs in the background
+        Returns an AsyncResult of the [(index, (structure, free energy)), ...] list
+        """
+        return self.pool.apply_async(_fold_chunk, ((parameters, list(indexed_sequences)),))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+# Shared engine, recreated when the worker count or the Vienna parameters change
+fold_engine = None
+
+def get_fold_engine(workers=None):
+    global fold_engine
+    workers = settings.WORKERS if workers is None else workers
+    if fold_engine is not None and (fold_engine.workers != workers or fold_engine.key != vienna_key()):
+        fold_engine.close()
+        fold_engine = None
+    if fold_engine is None:
+        fold_engine = FoldEngine(workers)
+    return fold_engine
+
+def fold_many(sequences, workers=None, ordered=True, chunk_size=None, cache=True, parameters=None):
+    """
+    Fold many sequences in parallel, with a parameter set or the global parameters
+
+    Returns a list of (structure, free energy) in input order if ordered=True,
+    otherwise an iterator of (index, (structure, free energy)) in order of completion.
+    Cached results are reused and new results are added to the fold cache.
+    """
+    results = _fold_many(list(sequences), workers, ordered, chunk_size, cache, parameters)
+    if ordered:
+        return [result for _, result in results]
+    return results
+
+def _fold_many(sequences, workers, ordered, chunk_size, cache, parameters):
+    workers = settings.WORKERS if workers is None else workers
+    folded, missing = {}, []
+    for i, sequence in enumerate(sequences):
+        result = fold_cache.get(sequence, key=cache_key(sequence, parameters)) if cache else None
+        if result is not None:
+            if ordered:
+                folded[i] = result
+            else:
+                yield i, result
+        else:
+            missing.append((i, sequence))
+
+    fold_fn = settings.fold_fn if parameters is None else parameters.fold
+    if isinstance(fold_fn, RNAfoldPool):
+        # Already parallel
+        computed = zip([i for i, _ in missing], fold_fn.fold_many([seq for _, seq in missing]))
+    elif workers <= 1 or len(missing) <= 1:
+        computed = ((i, tuple(fold_fn(sequence))) for i, sequence in missing)
+    else:
+        computed = get_fold_engine(workers).imap(missing, ordered=ordered, chunk_size=chunk_size, parameters=parameters)
+
+    for i, result in computed:
+        if cache:
+            fold_cache.put(sequences[i], result, key=cache_key(sequences[i], parameters), miss=True)
+        if ordered:
+            folded[i] = result
+        else:
+            yield i, result
+
+    if ordered:
+        for i in range(len(sequences)):
+            yield i, folded[i]
+
+def fold_stream(sequences, workers=None, chunk_size=64, max_in_flight=None, cache=True, parameters=None):
+    """
+    Fold an iterable of sequences lazily, yields (structure, free energy) in input order
+
+    The sequences are read in chunks and at most max_in_flight chunks (2 per worker
+    by default) are folded at a time, so a long input is consumed only as fast
+    as it is folded and the results can be used while the rest is still folding
+    """
+    workers = settings.WORKERS if workers is None else workers
+    sequences = iter(sequences)
+    fold_fn = settings.fold_fn if parameters is None else parameters.fold
+    if workers <= 1 or isinstance(fold_fn, RNAfoldPool):
+        while True:
+            chunk = list(itertools.islice(sequences, chunk_size))
+            if len(chunk) == 0:
+                return
+            for result in fold_many(chunk, workers=workers, cache=cache, parameters=parameters):
+                yield result
+
+    engine = get_fold_engine(workers)
+    max_in_flight = workers * 2 if max_in_flight is None else max_in_flight
+    pending = deque()
+    while True:
+        # Keep the pool busy
+        while len(pending) < max_in_flight:
+            chunk = list(itertools.islice(sequences, chunk_size))
+            if len(chunk) == 0:
+                break
+            results = [fold_cache.get(seq, key=cache_key(seq, parameters)) if cache else None for seq in chunk]
+            missing = [(i, seq) for i, seq in enumerate(chunk) if results[i] is None]
+            job = engine.submit(missing, parameters) if missing else None
+            pending.append((chunk, results, job))
+        if len(pending) == 0:
+            return
+
+        chunk, results, job = pending.popleft()
+        if job is not None:
+            for i, result in job.get():
+                results[i] = result
+                if cache:
+                    fold_cache.put(chunk[i], result, key=cache_key(chunk[i], parameters), miss=True)
+        for result in results:
+            yield result
+
+def fold_sweep(sequences, parameter_sets, workers=None, cache=True):
+    """
+    Fold the sequences with every parameter set, all of the sets share the process pool
+    Returns {parameter set: [(structure, free energy), ...]}
+    """
+    workers = settings.WORKERS if workers is None else workers
+    sequences = list(sequences)
+    parameter_sets = [get_parameter_set(parameters) for parameters in parameter_sets]
+    if workers <= 1:
+        return {parameters: fold_many(sequences, workers=1, cache=cache, parameters=parameters) for parameters in parameter_sets}
+
+    results = {parameters: [None] * len(sequences) for parameters in parameter_sets}
+    jobs = []
+    for n, parameters in enumerate(parameter_sets):
+        missing = []
+        for i, sequence in enumerate(sequences):
+            result = fold_cache.get(sequence, key=cache_key(sequence, parameters)) if cache else None
+            if result is not None:
+                results[parameters][i] = result
+            else:
+                missing.append(((n, i), sequence))
+        jobs.append((parameters, missing))
+
+    for (n, i), result in get_fold_engine(workers).imap_sets(jobs, ordered=False):
+        parameters = parameter_sets[n]
+        results[parameters][i] = result
+        if cache:
+            fold_cache.put(sequences[i], result, key=cache_key(sequences[i], parameters), miss=True)
+    return results
+
+# Persistent RNAfold processes used by fold()
+rnafold_pool = None
+
+def fold(sequence, worker=None):
+    """
+    For Windows
+    Fold the sequence with a pool of persistent RNAfold.exe processes and return
+    the folded secondary structure sequence and its free energy
+    """
+    global rnafold_pool
+    if rnafold_pool is None:
+        rnafold_pool = RNAfoldPool()
+    return rnafold_pool(sequence)
@@ -41,6 +41,7 @@ class ConfigManager():
     permutation_budget = 5
     permutation_radius = 2
     permutation_threshold = 5
+    FOLD_CACHE_SIZE = 100000
     TIME = 60
     WORKERS = 1
     ATTEMPTS = 20
@@ -62,10 +63,12 @@ class ConfigManager():
     os = sys.platform
     if sys.platform in ['linux', 'darwin']:
         fold_fn = RNA.fold
+        rnafold = 'RNAfold'
         delimiter = '/'
     elif sys.platform == 'win32':
         from rlif.rna import fold
         fold_fn = fold
+        rnafold = 'RNAfold.exe'
         delimiter = '\\'
     else: 
         print('Unknown OS.')
@@ -7,7 +7,7 @@ import os, random
 import copy, datetime, yaml
 import rlif
 import sys, subprocess, time
-from rlif.rna import set_vienna_params
+from rlif.rna import set_vienna_params, fold_many
 
 import sys
 
@@ -206,6 +206,7 @@ def mass_fold(seq, time_limit=10, file=None, log=None):
                         source=names[i])]
                 elif type(result) is list:
                     if type(result[0]) is str:
+                        fold_many(result)
                         solutions = [Solution(
                             target=target, 
                             config=config, 
@@ -231,6 +232,7 @@ def mass_fold(seq, time_limit=10, file=None, log=None):
                             best.fe, 
                             best.ensemble_defect, 
                             attempts)
+                        best.release()
 
                     if hd == 0:
                         solved[i] += 1
@@ -0,0 +1,208 @@
+"""
+Speed benchmarks of the folding and environment hot paths
+"""
+import os, time, random, argparse, pickle, yaml
+import numpy as np
+from rlif.settings import ConfigManager as settings
+from rlif.rna import Dataset, Solution, DotBracket, fold_cache
+
+def get_environment_config():
+    """
+    Default environment config merged with the testing config
+    """
+    with open(os.path.join(settings.CONFIG, 'RnaDesign.yml'), 'r') as f:
+        config = yaml.load(f)['environment']
+    return {**config, **settings.test_config}
+
+def random_design(target):
+    """
+    Random sequence that is complementary at the base pairs of the target
+    """
+    pairs = ['GC', 'CG', 'AU', 'UA']
+    sequence = [random.choice('ACGU') for _ in range(target.len)]
+    for i, j in target.base_pair_indices.items():
+        sequence[i], sequence[j] = random.choice(pairs)
+    return ''.join(sequence)
+
+def random_structure(length):
+    """
+    Random balanced dot-bracket structure with hairpins of at least 3 nucleotides
+    """
+    structure, opened = [], []
+    for i in range(length):
+        remaining = length - i
+        if opened and i - opened[-1] > 3 and (remaining <= len(opened) or random.random() < 0.3):
+            structure.append(')')
+            opened.pop()
+        elif remaining > len(opened) + 4 and random.random() < 0.3:
+            structure.append('(')
+            opened.append(i)
+        else:
+            structure.append('.')
+    return ''.join(structure)
+
+def parse_benchmark(n_structures=5000, lengths=(20, 100, 400), seed=0):
+    """
+    Time of parsing dot-bracket structures into DotBracket objects: the separate
+    passes over the string (parsed=False), the single-pass parser and parse_many
+    """
+    from rlif.rna.dotbracket import parse_many
+    random.seed(seed)
+    results = {}
+    for length in lengths:
+        structures = [random_structure(length) for _ in range(n_structures)]
+        times = []
+        for parse in [lambda structures: [DotBracket(s, parsed=False) for s in structures],
+                      lambda structures: [DotBracket(s) for s in structures],
+                      lambda structures: parse_many(structures)]:
+            parse(structures[:100]) # Warm up
+            t0 = time.time()
+            parse(structures)
+            times.append((time.time() - t0) / n_structures * 1e6)
+        results[length] = times
+        print('Length {:4}: separate passes {:7.1f} us, single pass {:7.1f} us, parse_many {:7.1f} us per structure'.format(length, *times))
+    return results
+
+def permutation_benchmark(dataset='eterna', n_seqs=100, starts=5, strategies=None, seed=0):
+    """
+    Compare the permutation search strategies on starting designs that are within the
+    permutation threshold of the target. Reports the solve rate per wall-second.
+    """
+    config = get_environment_config()
+    if strategies is None:
+        strategies = dict(
+            climber=dict(permutation_population=1, permutation_tabu=False),
+            tabu=dict(permutation_population=1, permutation_tabu='call'),
+            elitist=dict(permutation_population=8, permutation_strategy='elitist'),
+            beam=dict(permutation_population=8, permutation_strategy='beam', permutation_beam=3))
+
+    # Starting designs
+    random.seed(seed)
+    data = Dataset(dataset=dataset, start=1, n_seqs=n_seqs, encoding_type=config['encoding_type'])
+    designs = []
+    for target in data.sequences:
+        for _ in range(starts):
+            solution = Solution(target=target, config=config)
+            solution.str = list(random_design(target))
+            solution.evaluate()
+            if 0 < solution.hd <= config['permutation_threshold']:
+                designs.append((target, solution.string))
+    print('\nStarting designs within the permutation threshold: {}'.format(len(designs)))
+
+    results = {}
+    for name, parameters in strategies.items():
+        strategy_config = {**config, **parameters}
+        fold_cache.clear()
+        random.seed(seed)
+        solved, duplicates, t0 = 0, 0, time.time()
+        for target, string in designs:
+            solution = Solution(target=target, config=strategy_config)
+            solution.str = list(string)
+            solution.evaluate(permute=True)
+            solved += solution.hd == 0
+            duplicates += solution.duplicates_avoided
+        elapsed = time.time() - t0
+        results[name] = [solved, elapsed, fold_cache.misses, duplicates]
+        print('{:10} solved: {:4}/{:4}, time: {:7.2f}s, folds: {:6}, duplicates avoided: {:5}, solved/s: {:.3f}'.format(
+            name, solved, len(designs), elapsed, fold_cache.misses, duplicates, solved/elapsed))
+    return results
+
+def step_benchmark(dataset='eterna', n_seqs=100, episodes=200, mlp=False, seed=0):
+    """
+    Random-action throughput of RnaDesign.step and the size of the observations
+    Steps that end an episode (fold + reward) and resets are timed separately
+    """
+    from rlif.environments import RnaDesign
+    config = get_environment_config()
+    config['permute'] = False
+    env = RnaDesign(config)
+    env.testing_mode = False
+    env.use_mlp = mlp
+    env.set_data(Dataset(dataset=dataset, start=1, n_seqs=n_seqs, encoding_type=config['encoding_type']))
+
+    random.seed(seed)
+    steps, t_steps, t_final, t_reset = 0, 0., 0., 0.
+    state = env.reset()
+    for _ in range(episodes):
+        done = False
+        while not done:
+            action = random.randint(0, 3)
+            t0 = time.time()
+            state, _, done, _ = env.step(action)
+            t_step = time.time() - t0
+            if done:
+                t_final += t_step
+            else:
+                t_steps += t_step
+                steps += 1
+        t0 = time.time()
+        state = env.reset()
+        t_reset += time.time() - t0
+
+    observation = env.step(0)[0]
+    print('\nObservation: shape {}, dtype {}, {} bytes (pickled: {} bytes)'.format(
+        observation.shape, observation.dtype, observation.nbytes, len(pickle.dumps(observation))))
+    print('Steps/s (excluding episode ends): {:.0f}'.format(steps/t_steps))
+    print('Steps/s (including episode ends): {:.0f}'.format((steps+episodes)/(t_steps+t_final)))
+    print('Resets/s: {:.0f}'.format(episodes/t_reset))
+    return steps/t_steps
+
+def vec_benchmark(dataset='eterna', n_seqs=100, n_envs=64, steps=1000, seed=0):
+    """
+    Random-action throughput of the vectorized environments with n_envs episodes:
+    RnaDesign in a DummyVecEnv and a SubprocVecEnv, and BatchedRnaDesign
+    """
+    from stable_baselines.common.vec_env import DummyVecEnv, SubprocVecEnv
+    from rlif.environments import RnaDesign, BatchedRnaDesign
+    config = get_environment_config()
+    config['permute'] = False
+    data = Dataset(dataset=dataset, start=1, n_seqs=n_seqs, encoding_type=config['encoding_type'])
+
+    def make_env():
+        env = RnaDesign(config, dataset=data)
+        env.testing_mode = False
+        return env
+
+    results = {}
+    for name in ['DummyVecEnv', 'SubprocVecEnv', 'BatchedRnaDesign']:
+        fold_cache.clear()
+        random.seed(seed)
+        if name == 'BatchedRnaDesign':
+            env = BatchedRnaDesign(config, n_envs=n_envs, dataset=data)
+            env.testing_mode = False
+        elif name == 'DummyVecEnv':
+            env = DummyVecEnv([make_env] * n_envs)
+        else:
+            env = SubprocVecEnv([make_env] * n_envs, start_method='fork')
+        actions = np.random.RandomState(seed).randint(0, 4, [steps, n_envs])
+        env.reset()
+        episodes, t0 = 0, time.time()
+        for action in actions:
+            _, _, done, _ = env.step(action)
+            episodes += int(np.sum(done))
+        elapsed = time.time() - t0
+        env.close()
+        results[name] = steps * n_envs / elapsed
+        print('{:17} steps/s: {:9.0f}, episodes: {:5}'.format(name, results[name], episodes))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['permutation', 'step', 'parse', 'vec'])
+    parser.add_argument('-d', '--dataset', type=str, default='eterna')
+    parser.add_argument('-n', '--n_seqs', type=int, default=100)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-e', '--episodes', type=int, default=200)
+    parser.add_argument('--n_envs', type=int, default=64)
+    parser.add_argument('--mlp', action='store_true')
+    args = parser.parse_args()
+    settings.WORKERS = args.workers
+
+    if args.benchmark == 'permutation':
+        permutation_benchmark(dataset=args.dataset, n_seqs=args.n_seqs)
+    if args.benchmark == 'parse':
+        parse_benchmark(n_structures=args.n_seqs * 50)
+    if args.benchmark == 'step':
+        step_benchmark(dataset=args.dataset, n_seqs=args.n_seqs, episodes=args.episodes, mlp=args.mlp)
+    if args.benchmark == 'vec':
+        vec_benchmark(dataset=args.dataset, n_seqs=args.n_seqs, n_envs=args.n_envs)
@@ -0,0 +1,57 @@
+"""
+BatchedRnaDesign against a DummyVecEnv of RnaDesign environments with the same seeds:
+the observations, rewards, dones and episode records (apart from the time) have to match
+"""
+import random
+import numpy as np
+from stable_baselines.common.vec_env import DummyVecEnv
+from rlif.settings import get_parameters
+from rlif.rna import Dataset
+from rlif.environments import RnaDesign, BatchedRnaDesign
+
+def balanced_dataset(n_seqs=100, max_length=150):
+    dataset = Dataset(dataset='eterna', start=1, n_seqs=n_seqs, encoding_type=2, compiled=False)
+    dataset.sequences = [target for target in dataset.sequences
+                         if target.seq.count('(') == target.seq.count(')') and target.len <= max_length]
+    dataset.n_seqs = len(dataset.sequences)
+    return dataset
+
+def run(make_env, n_envs, steps, seed=0):
+    """
+    Observations, rewards and dones of every step and the (step, slot, EpisodeResult) records
+    """
+    random.seed(seed)
+    env = make_env()
+    actions = np.random.RandomState(seed).randint(0, 4, [steps, n_envs])
+    transitions, records = [env.reset()], []
+    for step, action in enumerate(actions):
+        obs, rewards, dones, infos = env.step(action)
+        transitions += [obs, np.asarray(rewards, dtype=np.float32), np.asarray(dones)]
+        records += [(step, slot, info['result']._replace(time=0.)) for slot, info in enumerate(infos) if 'result' in info]
+    env.close()
+    return transitions, records
+
+def test_batched_episodes(n_envs=4, steps=1500):
+    config = get_parameters('RnaDesign')['environment']
+    dataset = balanced_dataset()
+
+    def make_dummy():
+        env = DummyVecEnv([lambda: RnaDesign(config, 0, dataset=dataset) for _ in range(n_envs)])
+        for single in env.envs:
+            single.testing_mode = False
+        return env
+
+    def make_batched():
+        env = BatchedRnaDesign(config, n_envs=n_envs, dataset=dataset)
+        env.testing_mode = False
+        return env
+
+    dummy_transitions, dummy_records = run(make_dummy, n_envs, steps)
+    batched_transitions, batched_records = run(make_batched, n_envs, steps)
+    assert len(dummy_records) > 0
+    assert dummy_records == batched_records
+    assert all(np.array_equal(a, b) for a, b in zip(dummy_transitions, batched_transitions))
+
+if __name__ == "__main__":
+    test_batched_episodes()
+    print('BatchedRnaDesign tests passed')
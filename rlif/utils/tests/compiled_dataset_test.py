@@ -0,0 +1,41 @@
+"""
+Targets of a compiled dataset (compile_dataset/CompiledDataset) against the targets
+parsed from the .rna files of the dataset
+"""
+import os, tempfile
+import numpy as np
+from rlif.rna import load_sequence
+from rlif.rna.dataset import compile_dataset, CompiledDataset, DotBracketViews
+
+DATASET = 'eterna'
+
+def assert_same_target(compiled, loaded):
+    assert compiled.seq == loaded.seq
+    assert compiled.file_nr == loaded.file_nr
+    assert compiled.struct_motifs == loaded.struct_motifs
+    assert dict(compiled.counter) == dict(loaded.counter)
+    assert compiled.base_pair_indices == loaded.base_pair_indices
+    assert compiled.loops == loaded.loops
+    assert np.array_equal(compiled.pair_table, loaded.pair_table)
+    assert np.array_equal(compiled.schedule, loaded.schedule)
+    assert np.array_equal(compiled.structure_encoding, loaded.structure_encoding)
+
+def test_compiled_targets():
+    """
+    Every record in every encoding, read directly and through DotBracketViews
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        compiled = CompiledDataset(path=compile_dataset(DATASET, path=os.path.join(directory, DATASET + '.rds')))
+        assert np.all(np.diff(compiled.lengths[compiled.length_order]) >= 0)
+        for encoding_type in [0, 1, 2, 3]:
+            loaded = [load_sequence(int(file_nr), dataset=DATASET, encoding_type=encoding_type) for file_nr in compiled.file_nrs]
+            for record, target in enumerate(loaded):
+                assert_same_target(compiled.target(record, encoding_type), target)
+            views = DotBracketViews(compiled, compiled.records(compiled.file_nrs), encoding_type)
+            for view, target in zip(views, loaded):
+                assert_same_target(view, target)
+        del compiled, views
+
+if __name__ == "__main__":
+    test_compiled_targets()
+    print('Compiled dataset tests passed')
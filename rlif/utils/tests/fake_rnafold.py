@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Minimal stand-in for the RNAfold executable for testing RNAfoldPool without ViennaRNA
+
+Reads FASTA records / sequences from stdin and writes RNAfold-style output:
+    >name
+    SEQUENCE
+    ..((....)).. ( -1.20)
+
+Usage:
+    pool = RNAfoldPool(n_workers=2, executable='path/to/fake_rnafold.py')
+
+Set FAKE_RNAFOLD_CRASH_AFTER=n to make the process exit after n records.
+"""
+import os, sys
+
+def fake_structure(sequence):
+    """
+    Pairs G-C from the outside in, everything else stays unpaired
+    """
+    structure = ['.'] * len(sequence)
+    i, j = 0, len(sequence) - 1
+    while j - i > 3:
+        if {sequence[i], sequence[j]} == {'G', 'C'}:
+            structure[i], structure[j] = '(', ')'
+        i += 1
+        j -= 1
+    structure = ''.join(structure)
+    return structure, -1.1 * structure.count('(')
+
+if __name__ == "__main__":
+    # Command line options of RNAfold are accepted and ignored
+    crash_after = int(os.environ.get('FAKE_RNAFOLD_CRASH_AFTER', 0))
+    count = 0
+    for line in sys.stdin:
+        line = line.strip()
+        if len(line) == 0 or line.startswith('-'):
+            continue
+        if line.startswith('>'):
+            sys.stdout.write(line + '\n')
+            continue
+        sequence = line.upper().replace('T', 'U')
+        structure, energy = fake_structure(sequence)
+        sys.stdout.write('{}\n{} ({:6.2f})\n'.format(sequence, structure, energy))
+        sys.stdout.flush()
+        count += 1
+        if crash_after and count >= crash_after:
+            sys.exit(1)
@@ -0,0 +1,54 @@
+"""
+RNAfoldPool against the fake RNAfold executable (fake_rnafold.py), no ViennaRNA needed
+"""
+import os, sys, random, importlib.util
+from rlif.rna.rnafold import RNAfoldPool
+
+FAKE_RNAFOLD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_rnafold.py')
+
+def load_fake():
+    spec = importlib.util.spec_from_file_location('fake_rnafold', FAKE_RNAFOLD)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def expected(fake, sequences):
+    # The energies are printed with two decimals
+    return [(structure, round(energy, 2)) for structure, energy in map(fake.fake_structure, sequences)]
+
+def random_sequences(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGU') for _ in range(rng.randint(5, 60))) for _ in range(n)]
+
+def test_output_order():
+    """
+    Results come back in input order, across chunks and workers, without the flush records
+    """
+    fake = load_fake()
+    sequences = random_sequences(200)
+    with RNAfoldPool(n_workers=2, executable=FAKE_RNAFOLD, options=[], chunk_size=16) as pool:
+        results = pool.fold_many(sequences)
+        single = pool(sequences[0])
+    assert results == expected(fake, sequences)
+    assert single == results[0]
+
+def test_crash_recovery():
+    """
+    Workers that exit mid-stream are restarted and their chunk is resubmitted
+    """
+    fake = load_fake()
+    sequences = random_sequences(50, seed=1)
+    os.environ['FAKE_RNAFOLD_CRASH_AFTER'] = '6'
+    try:
+        with RNAfoldPool(n_workers=1, executable=FAKE_RNAFOLD, options=[], chunk_size=4, max_retries=2) as pool:
+            results = pool.fold_many(sequences)
+            restarts = pool.restarts
+    finally:
+        del os.environ['FAKE_RNAFOLD_CRASH_AFTER']
+    assert results == expected(fake, sequences)
+    assert restarts > 0
+
+if __name__ == "__main__":
+    test_output_order()
+    test_crash_recovery()
+    print('RNAfoldPool tests passed')